@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright 2022 Greg Albrecht <oss@undef.net>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Author:: Greg Albrecht W2GMD <oss@undef.net>
+#
+
+"""
+Compares COTProxy throughput on the asyncio & uvloop event loops.
+
+Measures:
+- UDP ingest: CoT Events sent over loopback UDP into a `NetListener`.
+- End-to-end: UDP ingest through `COTProxyWorker`, transforming every Event
+  with Transforms looked up from an in-process COTProxyWeb API stub.
+
+Usage: python3 benchmarks/loop_benchmark.py [-n EVENTS] [-l asyncio,uvloop]
+"""
+
+import argparse
+import asyncio
+import logging
+import time
+
+from configparser import ConfigParser
+
+from aiohttp import web
+
+import cotproxy
+
+EVENT: str = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<event version="2.0" uid="bench-{uid}" type="a-f-G-U-C" how="m-g" '
+    'time="{time}" start="{time}" stale="{stale}">'
+    '<point lat="37.76" lon="-122.4975" hae="9999999.0" ce="9999999.0" '
+    'le="9999999.0"/><detail><contact callsign="BENCH-{uid}"/></detail></event>'
+)
+
+# Events in flight before the sender waits for the receiver, so the benchmark
+# measures throughput rather than loopback UDP socket buffer overruns:
+WINDOW: int = 200
+
+
+def make_events(count: int, uids: int) -> list:
+    """Returns `count` CoT Events spread over `uids` UIDs."""
+    now: float = time.time()
+    cot_time = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(now))
+    stale = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(now + 3600))
+    return [
+        EVENT.format(uid=index % uids, time=cot_time, stale=stale).encode()
+        for index in range(count)
+    ]
+
+
+class Progress:
+
+    """Events received so far, shared by a sender & its receiver."""
+
+    received: int = 0
+    last: float = 0.0
+
+
+async def send_udp(events: list, addr, progress: Progress) -> None:
+    """Sends each Event as a UDP datagram to `addr`, at most WINDOW in flight."""
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(
+        asyncio.DatagramProtocol, remote_addr=addr
+    )
+    for index, event in enumerate(events):
+        # Lost datagrams never arrive, so only wait so long for the receiver:
+        deadline: float = time.perf_counter() + 0.1
+        while index - progress.received >= WINDOW and time.perf_counter() < deadline:
+            await asyncio.sleep(0)
+        transport.sendto(event)
+    transport.close()
+
+
+async def drain(
+    queue: asyncio.Queue, count: int, timeout: float, progress: Progress
+) -> int:
+    """
+    Gets up to `count` items from `queue`, returns how many were received.
+
+    Gives up after `timeout` seconds without an item, as UDP may lose some.
+    """
+    try:
+        while progress.received < count:
+            await asyncio.wait_for(queue.get(), timeout)
+            progress.received += 1
+            progress.last = time.perf_counter()
+    except asyncio.TimeoutError:
+        pass
+    return progress.received
+
+
+async def udp_ingest(events: list) -> tuple:
+    """Benchmarks UDP ingest, returns the Events received and seconds taken."""
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+    transport, _ = await loop.create_datagram_endpoint(
+        lambda: cotproxy.NetListener(queue, asyncio.Event()),
+        local_addr=("127.0.0.1", 0),
+    )
+    addr = transport.get_extra_info("sockname")
+
+    progress = Progress()
+    start: float = time.perf_counter()
+    sender = asyncio.ensure_future(send_udp(events, addr, progress))
+    received: int = await drain(queue, len(events), 1.0, progress)
+    elapsed: float = progress.last - start
+    await sender
+    transport.close()
+    return received, elapsed
+
+
+async def start_cpapi() -> tuple:
+    """Starts a COTProxyWeb API stub with an active Transform for every UID."""
+
+    async def batch(request):
+        uids: list = (await request.json())["uids"]
+        return web.json_response(
+            [{"cot_uid": uid, "active": True, "callsign": "XFORM"} for uid in uids]
+        )
+
+    app = web.Application()
+    app.router.add_post(cotproxy.DEFAULT_CPAPI_BATCH_PATH, batch)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port: int = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}/"
+
+
+async def end_to_end(events: list) -> tuple:
+    """Benchmarks UDP ingest through transforming, returns Events out & seconds."""
+    loop = asyncio.get_running_loop()
+    runner, cpapi_url = await start_cpapi()
+
+    config = ConfigParser()
+    config["cotproxy"] = {
+        "COT_URL": "udp://127.0.0.1:6969",
+        "CPAPI_URL": cpapi_url,
+        "STATS_INTERVAL": "0",
+    }
+    tf_queue: asyncio.Queue = asyncio.Queue()
+    tx_queue: asyncio.Queue = asyncio.Queue()
+    worker = cotproxy.COTProxyWorker(tx_queue, config["cotproxy"], tf_queue)
+    worker_task = asyncio.ensure_future(worker.run())
+
+    transport, _ = await loop.create_datagram_endpoint(
+        lambda: cotproxy.NetListener(tf_queue, asyncio.Event()),
+        local_addr=("127.0.0.1", 0),
+    )
+    addr = transport.get_extra_info("sockname")
+
+    progress = Progress()
+    start: float = time.perf_counter()
+    sender = asyncio.ensure_future(send_udp(events, addr, progress))
+    received: int = await drain(tx_queue, len(events), 2.0, progress)
+    elapsed: float = progress.last - start
+
+    await sender
+    transport.close()
+    worker_task.cancel()
+    await asyncio.gather(worker_task, return_exceptions=True)
+    await runner.cleanup()
+    return received, elapsed
+
+
+def run_benchmark(name: str, events: list) -> None:
+    """Runs each benchmark on a new event loop of the named implementation."""
+    policy = cotproxy.event_loop_policy(name)
+    for bench in (udp_ingest, end_to_end):
+        loop = policy.new_event_loop()
+        try:
+            received, elapsed = loop.run_until_complete(bench(events))
+        finally:
+            loop.close()
+        print(
+            f"{name:8} {bench.__name__:11} {received:8}/{len(events)} events "
+            f"{elapsed:7.3f}s {received / elapsed:10.1f} events/s"
+        )
+
+
+def main() -> None:
+    """Main function."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument(
+        "-n", "--EVENTS", dest="EVENTS", default=20000, type=int, help="Events."
+    )
+    parser.add_argument(
+        "-u", "--UIDS", dest="UIDS", default=1000, type=int, help="Distinct UIDs."
+    )
+    parser.add_argument(
+        "-l",
+        "--LOOPS",
+        dest="LOOPS",
+        default="asyncio,uvloop",
+        help="Comma separated event loops to compare.",
+    )
+    namespace = parser.parse_args()
+
+    # Per-Event logging would dominate the measurements:
+    for logger in (cotproxy.COTProxyWorker._logger, cotproxy.NetListener._logger):
+        logger.setLevel(logging.CRITICAL)
+
+    events: list = make_events(namespace.EVENTS, namespace.UIDS)
+    for name in namespace.LOOPS.split(","):
+        if name == "uvloop" and not cotproxy.functions.with_uvloop:
+            print("uvloop not installed, skipping.")
+            continue
+        run_benchmark(name, events)
+
+
+if __name__ == "__main__":
+    main()
@@ -36,9 +36,79 @@ from .constants import (  # NOQA
     DEFAULT_LISTEN_URL,
     DEFAULT_KNOWN_CRAFT_FILE,
     DEFAULT_SEED_FAA_REG,
+    DEFAULT_DROP_STALE,
+    DEFAULT_EVENT_LOOP,
+    DEFAULT_CPAPI_POOL_SIZE,
+    DEFAULT_CPAPI_KEEPALIVE,
+    DEFAULT_CPAPI_TIMEOUT,
+    DEFAULT_CPAPI_BATCH_PATH,
+    DEFAULT_LOOKUP_WINDOW,
+    DEFAULT_LOOKUP_BATCH,
+    DEFAULT_TF_CACHE_TTL,
+    DEFAULT_TF_CACHE_SIZE,
+    DEFAULT_CPAPI_EVENTS_PATH,
+    DEFAULT_SUBSCRIBE_TIMEOUT,
+    DEFAULT_CACHE_FILE,
+    DEFAULT_CACHE_SAVE_INTERVAL,
+    DEFAULT_AUTO_ADD_WINDOW,
+    DEFAULT_AUTO_ADD_BATCH,
+    DEFAULT_AUTO_ADD_RETRIES,
+    DEFAULT_MAX_AUTO_ADD_QUEUE,
+    DEFAULT_STATS_INTERVAL,
+    DEFAULT_PRIORITY_CLASSES,
+    DEFAULT_PRIORITY_MAX_WAIT,
+    DEFAULT_MAX_TF_QUEUE,
+    DEFAULT_SHED_TARGET,
+    DEFAULT_SHED_HOLD,
+    DEFAULT_THIN_INTERVAL,
+    DEFAULT_THIN_DISTANCE,
+    DEFAULT_THIN_COURSE,
+    DEFAULT_THIN_ALTITUDE,
+    DEFAULT_THIN_MAX_TRACKS,
+    DEFAULT_GEOFENCE_FILE,
+    DEFAULT_GEOFENCE_CELL_SIZE,
+    DEFAULT_CAPTURE_FILE,
+    DEFAULT_REPLAY_URL,
+    DEFAULT_SPOOL_DIR,
+    DEFAULT_SPOOL_MAX_BYTES,
+    DEFAULT_SPOOL_MAX_AGE,
+    DEFAULT_SPOOL_SEGMENT_BYTES,
+    DEFAULT_SPOOL_DRAIN_RATE,
+    DEFAULT_EGRESS_COALESCE,
+    DEFAULT_EGRESS_MAX_BYTES,
+    DEFAULT_EGRESS_MAX_COUNT,
+    DEFAULT_EGRESS_LINGER,
+    DEFAULT_POOL,
+    DEFAULT_POOL_WORKERS,
+    DEFAULT_POOL_BATCH,
+    DEFAULT_MAX_CONNECTIONS,
+    DEFAULT_MAX_BUFFER,
+    DEFAULT_IDLE_TIMEOUT,
 )
 
-from .classes import NetListener, NetWorker, COTProxyWorker  # NOQA
+from .classes import (  # NOQA
+    NetListener,
+    NetWorker,
+    COTProxyWorker,
+    AutoAddWorker,
+    CoTEvent,
+    PeerStats,
+    CaptureWriter,
+    TypePriorityQueue,
+    ProxySettings,
+    TransformCache,
+    TransformLookup,
+    TransformSubscription,
+    LoadShedder,
+    TrackThinner,
+    GeofenceIndex,
+    EgressSpool,
+    SpoolWorker,
+    FanoutWorker,
+    CoalescingTXWorker,
+    PoolBatcher,
+    EventParser,
+)
 
 from .functions import (  # NOQA
     parse_cot,
@@ -46,6 +116,30 @@ from .functions import (  # NOQA
     get_callsign,
     parse_cot_multi,
     create_tasks,
+    coalesce_tx_workers,
+    worker_pool,
+    map_batch,
+    render_transform,
+    cot_time_to_epoch,
+    split_events,
+    tag_attrib,
+    parse_events,
+    read_varint,
+    split_proto,
+    parse_proto_events,
+    takmsg_to_xml,
+    distance,
+    point_in_polygon,
+    parse_priority_classes,
+    pack_record,
+    unpack_records,
+    load_config,
+    cpapi_session,
+    event_loop_policy,
+    save_cache_snapshot,
+    load_cache_snapshot,
+    read_capture,
+    replay_capture,
 )
 
 __author__ = "Greg Albrecht W2GMD <oss@undef.net>"
@@ -19,20 +19,232 @@
 """COTProxy Class Definitions."""
 
 import asyncio
+import collections
+import concurrent.futures
+import gzip
+import json
 import logging
+import math
+import mmap
+import os
+import signal
+import time
 import xml.etree.ElementTree as ET
 
+from dataclasses import dataclass
+from typing import Union
+
 import aiohttp
 
 import pytak
 import cotproxy
 
+try:
+    import takproto
+except ImportError:
+    takproto = None
+
 
 __author__ = "Greg Albrecht W2GMD <oss@undef.net>"
 __copyright__ = "Copyright 2022 Greg Albrecht"
 __license__ = "Apache License, Version 2.0"
 
 
+class CoTEvent:
+
+    """
+    Compact record of a received CoT Event as it travels through the queues.
+
+    Holds the raw bytes plus the fields COTProxy uses, extracted without
+    building an `xml.etree.ElementTree` tree. A tree is only built with
+    `element()` when a transform needs one.
+    """
+
+    __slots__ = (
+        "raw",
+        "uid",
+        "cot_type",
+        "callsign",
+        "time",
+        "stale",
+        "lat",
+        "lon",
+        "hae",
+        "course",
+    )
+
+    def __init__(
+        self,
+        raw: bytes,
+        uid: Union[str, None] = None,
+        cot_type: Union[str, None] = None,
+        callsign: Union[str, None] = None,
+        time: Union[float, None] = None,
+        stale: Union[float, None] = None,
+        lat: Union[float, None] = None,
+        lon: Union[float, None] = None,
+        hae: Union[float, None] = None,
+        course: Union[float, None] = None,
+    ) -> None:
+        self.raw = raw
+        self.uid = uid
+        self.cot_type = cot_type
+        self.callsign = callsign
+        self.time = time
+        self.stale = stale
+        self.lat = lat
+        self.lon = lon
+        self.hae = hae
+        self.course = course
+
+    @classmethod
+    def from_bytes(cls, raw: bytes) -> "CoTEvent":
+        """Extracts a `CoTEvent` from the raw bytes of a single CoT Event."""
+        event = cls(raw)
+        tag = cotproxy.functions.EVENT_TAG_RE.search(raw)
+        if tag:
+            attrib: dict = cotproxy.tag_attrib(tag.group())
+            event.uid = attrib.get("uid")
+            event.cot_type = attrib.get("type")
+            event.time = cotproxy.cot_time_to_epoch(attrib.get("time"))
+            event.stale = cotproxy.cot_time_to_epoch(attrib.get("stale"))
+
+        point = cotproxy.functions.POINT_TAG_RE.search(raw)
+        if point:
+            attrib = cotproxy.tag_attrib(point.group())
+            try:
+                event.lat = float(attrib["lat"])
+                event.lon = float(attrib["lon"])
+                event.hae = float(attrib["hae"])
+            except (KeyError, ValueError):
+                pass
+            # 9999999.0 is CoT for 'unknown':
+            if event.hae is not None and event.hae >= 9999999.0:
+                event.hae = None
+
+        track = cotproxy.functions.TRACK_TAG_RE.search(raw)
+        if track:
+            try:
+                event.course = float(cotproxy.tag_attrib(track.group())["course"])
+            except (KeyError, ValueError):
+                pass
+
+        callsign = cotproxy.functions.CALLSIGN_RE.search(raw)
+        if callsign:
+            event.callsign = cotproxy.tag_attrib(callsign.group()).get("callsign")
+        return event
+
+    def element(self) -> ET.Element:
+        """Builds an `xml.etree.ElementTree.Element` tree of this Event."""
+        return cotproxy.parse_cot(self.raw)
+
+
+class PoolBatcher:
+
+    """
+    Runs `func` over items in a worker pool, a batch at a time.
+
+    Items submitted in the same event loop iteration (up to `max_batch`) are
+    sent to the pool together, sparing a pool round trip per item.
+    """
+
+    def __init__(
+        self,
+        pool: concurrent.futures.Executor,
+        func,
+        max_batch: int = cotproxy.DEFAULT_POOL_BATCH,
+    ) -> None:
+        self.pool = pool
+        self.func = func
+        self.max_batch = max_batch
+        self.pending: list = []
+        self._scheduled: bool = False
+
+    def submit(self, item) -> asyncio.Future:
+        """Queues an item, returning a Future of `func(item)`."""
+        loop = asyncio.get_running_loop()
+        future: asyncio.Future = loop.create_future()
+        self.pending.append((item, future))
+        if len(self.pending) >= self.max_batch:
+            self.flush()
+        elif not self._scheduled:
+            self._scheduled = True
+            loop.call_soon(self.flush)
+        return future
+
+    def flush(self) -> None:
+        """Sends all queued items to the pool."""
+        self._scheduled = False
+        batch, self.pending = self.pending, []
+        if not batch:
+            return
+        result = asyncio.get_running_loop().run_in_executor(
+            self.pool, cotproxy.map_batch, self.func, [item for item, _ in batch]
+        )
+        result.add_done_callback(lambda result: self._resolve(batch, result))
+
+    @staticmethod
+    def _resolve(batch: list, result: asyncio.Future) -> None:
+        if result.cancelled() or result.exception() is not None:
+            exc = asyncio.CancelledError() if result.cancelled() else result.exception()
+            outcomes: list = [(False, exc)] * len(batch)
+        else:
+            outcomes = result.result()
+        for (_, future), (ok, value) in zip(batch, outcomes):
+            if future.done():
+                continue
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+
+class EventParser:
+
+    """
+    Parses received data into `CoTEvent`s onto a queue, in the order received.
+
+    With a `PoolBatcher` of `parse_events`, parsing happens in its worker pool
+    and the protocol callbacks only queue the data.
+    """
+
+    _logger = logging.getLogger(__name__)
+
+    def __init__(
+        self, queue: asyncio.Queue, batcher: Union[PoolBatcher, None] = None
+    ) -> None:
+        self.queue = queue
+        self.batcher = batcher
+        self.pending: collections.deque = collections.deque()
+
+    def feed(self, data: bytes) -> None:
+        """Parses data, queueing each CoT Event within once parsed."""
+        if self.batcher is None:
+            try:
+                self.put(cotproxy.parse_events(data))
+            except Exception as exc:
+                self._logger.debug(exc)
+            return
+
+        future: asyncio.Future = self.batcher.submit(data)
+        self.pending.append(future)
+        future.add_done_callback(self._drain)
+
+    def _drain(self, _=None) -> None:
+        # Results are queued in the order received, not the order parsed:
+        while self.pending and self.pending[0].done():
+            future: asyncio.Future = self.pending.popleft()
+            try:
+                self.put(future.result())
+            except Exception as exc:
+                self._logger.debug(exc)
+
+    def put(self, events: list) -> None:
+        """Queues parsed CoT Events."""
+        for event in events:
+            self.queue.put_nowait(event)
+
+
 class NetListener(asyncio.Protocol):
 
     """Starts a network listener for COTProxy."""
@@ -47,9 +259,11 @@ class NetListener(asyncio.Protocol):
         _logger.propagate = False
     logging.getLogger("asyncio").setLevel(cotproxy.LOG_LEVEL)
 
-    def __init__(self, queue, ready) -> None:
+    def __init__(self, queue, ready, capture=None, parser=None) -> None:
         self.queue = queue
         self.ready = ready
+        self.capture = capture
+        self.parser: EventParser = parser or EventParser(queue)
         self.transport = None
         self.address = None
 
@@ -68,39 +282,139 @@ class NetListener(asyncio.Protocol):
 
     def data_received(self, data):
         """Called when data is received."""
-        data = data.decode()
+        if self.capture:
+            self.capture.write(data)
         self._logger.debug("Data received: %r", data)
-        for line in data.splitlines():
-            self.handle_data(line)
+        self.handle_data(data)
 
     def datagram_received(self, data, addr):
         """Called when a UDP datagram is received."""
-        data = data.decode()
+        if self.capture:
+            self.capture.write(data)
         self._logger.debug("Recieved from %s: '%s'", addr, data)
-        for line in data.splitlines():
-            self.handle_data(line)
+        self.handle_data(data)
+
+    def handle_data(self, data: bytes) -> None:
+        """Handles received data, queueing each CoT Event within."""
+        self.parser.feed(data)
+
+
+class PeerStats:
+
+    """Per-peer event accounting for the TCP listener."""
+
+    # Time constant (seconds) of the exponentially decayed event rate.
+    RATE_WINDOW: float = 10.0
+
+    def __init__(self, peer) -> None:
+        self.peer = peer
+        self.connected = time.time()
+        self.last_seen = time.monotonic()
+        self.events = 0
+        self.bytes = 0
+        self._rate = 0.0
+
+    def update(self, size: int) -> None:
+        """Accounts for one received event of `size` bytes."""
+        now = time.monotonic()
+        self._rate = self._decay(now) + 1.0 / self.RATE_WINDOW
+        self.last_seen = now
+        self.events += 1
+        self.bytes += size
+
+    def _decay(self, now: float) -> float:
+        return self._rate * math.exp(-(now - self.last_seen) / self.RATE_WINDOW)
+
+    @property
+    def rate(self) -> float:
+        """Recent events per second from this peer."""
+        return self._decay(time.monotonic())
+
+    def as_dict(self) -> dict:
+        """Returns a snapshot of this peer's counters."""
+        return {
+            "peer": self.peer,
+            "connected": self.connected,
+            "idle": time.monotonic() - self.last_seen,
+            "events": self.events,
+            "bytes": self.bytes,
+            "rate": self.rate,
+        }
+
+
+class CaptureWriter:
+
+    """
+    Records raw received CoT with receive timestamps to a capture file for
+    later replay with `cotproxy-replay`. Files ending in '.gz' are compressed.
+
+    Writes are flushed every FLUSH_INTERVAL seconds by `flush_periodically()`,
+    so a capture that isn't closed cleanly (e.g. on SIGTERM) stays readable.
+    """
+
+    FLUSH_INTERVAL: float = 1.0
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.events: int = 0
+        opener = gzip.open if path.endswith(".gz") else open
+        self._fd = opener(path, "ab")
+        self._unflushed: bool = False
+
+    def write(self, data: bytes) -> None:
+        """Records data received now."""
+        self._fd.write(cotproxy.pack_record(time.time(), data))
+        self.events += 1
+        self._unflushed = True
+
+    def flush(self) -> None:
+        """Flushes records written so far to the capture file."""
+        if self._unflushed:
+            self._fd.flush()
+            self._unflushed = False
+
+    async def flush_periodically(self) -> None:
+        """Flushes the capture file every FLUSH_INTERVAL seconds."""
+        while 1:
+            await asyncio.sleep(self.FLUSH_INTERVAL)
+            self.flush()
+
+    def close(self) -> None:
+        """Flushes & closes the capture file."""
+        self._fd.close()
 
-    def handle_data(self, data) -> None:
-        """Handles received TCP data."""
-        self._logger.debug("Received Data='%s'", data)
-        try:
-            if "<?xml" in data:
-                data = data.strip('<?xml version="1.0" encoding="UTF-8"?>')
-                root = cotproxy.parse_cot(data)
-                if root:
-                    self.queue.put_nowait(root)
-            else:
-                for event in cotproxy.parse_cot_multi(data):
-                    self.queue.put_nowait(event)
-        except Exception as exc:
-            # print(data)
-            self._logger.debug(exc)
-            
 
 class NetWorker(pytak.Worker):
 
     """Starts an incoming network data worker."""
 
+    # TCP clients listed in the periodic metrics, busiest first:
+    TOP_PEERS: int = 5
+
+    def __init__(
+        self,
+        queue: asyncio.Queue,
+        config,
+        pool: Union[concurrent.futures.Executor, None] = None,
+    ) -> None:
+        super().__init__(queue, config)
+        self.pool = pool
+        self.parser: Union[EventParser, None] = None
+        self.peers: dict = {}
+        self.max_connections: int = int(
+            self.config.get("MAX_CONNECTIONS", cotproxy.DEFAULT_MAX_CONNECTIONS)
+        )
+        self.max_buffer: int = int(
+            self.config.get("MAX_BUFFER", cotproxy.DEFAULT_MAX_BUFFER)
+        )
+        self.idle_timeout: float = float(
+            self.config.get("IDLE_TIMEOUT", cotproxy.DEFAULT_IDLE_TIMEOUT)
+        )
+        self.stats_interval: int = int(
+            self.config.get("STATS_INTERVAL", cotproxy.DEFAULT_STATS_INTERVAL)
+        )
+        self.capture = None
+
     async def run(self, number_of_iterations=-1):
         """Runs the Thread."""
 
@@ -109,16 +423,152 @@ class NetWorker(pytak.Worker):
         )
         host, port = pytak.parse_url(listen_url)
 
-        if "tcp" in listen_url:
-            await self.start_tcp_listener(host, port)
-        elif "udp" in listen_url:
-            await self.start_udp_listener(host, port)
+        capture_file: str = self.config.get(
+            "CAPTURE_FILE", cotproxy.DEFAULT_CAPTURE_FILE
+        )
+        flusher = None
+        if capture_file:
+            self._logger.info("Capturing received CoT to: %s", capture_file)
+            self.capture = CaptureWriter(capture_file)
+            flusher = asyncio.ensure_future(self.capture.flush_periodically())
+
+        batcher = None
+        if self.pool is not None:
+            batcher = PoolBatcher(
+                self.pool,
+                cotproxy.parse_events,
+                int(self.config.get("POOL_BATCH", cotproxy.DEFAULT_POOL_BATCH)),
+            )
+        self.parser = EventParser(self.queue, batcher)
+
+        reporter = None
+        if "tcp" in listen_url and self.stats_interval:
+            reporter = asyncio.ensure_future(self.report_peers_periodically())
+
+        try:
+            if "tcp" in listen_url:
+                await self.start_tcp_listener(host, port)
+            elif "udp" in listen_url:
+                await self.start_udp_listener(host, port)
+        finally:
+            if reporter:
+                reporter.cancel()
+            if flusher:
+                flusher.cancel()
+            if self.capture:
+                self.capture.close()
+
+    def peer_stats(self) -> list:
+        """Returns per-peer accounting for all connected TCP clients."""
+        return [stats.as_dict() for stats in self.peers.values()]
+
+    def report_peers(self) -> None:
+        """Logs the number of TCP clients, and the busiest by recent event rate."""
+        peers: list = sorted(
+            self.peer_stats(), key=lambda stats: stats["rate"], reverse=True
+        )
+        self._logger.info(
+            "peers=%s top=[%s]",
+            len(peers),
+            ", ".join(
+                "%s %.1f/s" % (self.peer_name(stats["peer"]), stats["rate"])
+                for stats in peers[: self.TOP_PEERS]
+            ),
+        )
+
+    @staticmethod
+    def peer_name(peer) -> str:
+        """Formats a peer address as host:port, its peername may be None."""
+        if isinstance(peer, tuple) and len(peer) >= 2:
+            return f"{peer[0]}:{peer[1]}"
+        return str(peer)
+
+    async def report_peers_periodically(self) -> None:
+        """Reports TCP client metrics every STATS_INTERVAL seconds."""
+        while 1:
+            await asyncio.sleep(self.stats_interval)
+            self.report_peers()
 
     async def handle_rx(self, reader, writer):
+        """Handles a single TCP client connection."""
+        peer = writer.get_extra_info("peername")
+        if len(self.peers) >= self.max_connections:
+            self._logger.warning(
+                "Rejecting %s, MAX_CONNECTIONS=%s reached", peer, self.max_connections
+            )
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+            return
+
+        stats = PeerStats(peer)
+        self.peers[peer] = stats
+        self._logger.debug("Connection from %s", peer)
+        try:
+            while 1:
+                try:
+                    data: bytes = await asyncio.wait_for(
+                        self.read_event(reader), timeout=self.idle_timeout or None
+                    )
+                except asyncio.TimeoutError:
+                    self._logger.info(
+                        "Closing %s, idle for %ss", peer, self.idle_timeout
+                    )
+                    break
+                except asyncio.LimitOverrunError:
+                    self._logger.warning(
+                        "Closing %s, exceeded MAX_BUFFER=%s", peer, self.max_buffer
+                    )
+                    break
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+
+                self._logger.debug("RX: %s", data)
+                stats.update(len(data))
+                if self.capture:
+                    self.capture.write(data)
+                if self.parser is None:
+                    self.parser = EventParser(self.queue)
+                self.parser.feed(data)
+        finally:
+            del self.peers[peer]
+            writer.close()
+            self._logger.info(
+                "Disconnected from %s after %s events (%s bytes)",
+                peer,
+                stats.events,
+                stats.bytes,
+            )
+
+    async def read_event(self, reader: asyncio.StreamReader) -> bytes:
+        """
+        Reads the next CoT Event from a TCP client, as CoT XML or TAK Protocol.
+
+        TAK Protocol Stream messages are framed by the magic byte & a varint
+        length, everything else is read up to the closing event tag.
+        """
+        first: bytes = await reader.readexactly(1)
+        # Skip whitespace (e.g. newlines) between Events:
+        while first.isspace():
+            first = await reader.readexactly(1)
+        if first != cotproxy.functions.TAK_MAGIC:
+            return first + await reader.readuntil("</event>".encode("UTF-8"))
+
+        header: bytes = first
         while 1:
-            data: bytes = await reader.readuntil("</event>".encode("UTF-8"))
-            self._logger.debug("RX: %s", data)
-            self.queue.put_nowait(data)
+            byte: bytes = await reader.readexactly(1)
+            header += byte
+            if not byte[0] & 0x80 or len(header) > 10:
+                break
+        try:
+            length, _ = cotproxy.read_varint(header, 1)
+        except ValueError:
+            raise asyncio.IncompleteReadError(header, None)
+        if length > self.max_buffer:
+            raise asyncio.LimitOverrunError("TAK Protocol message too long", length)
+        return header + await reader.readexactly(length)
 
     async def start_udp_listener(self, host, port):
         """Starts a UDP Network Listener."""
@@ -127,7 +577,7 @@ class NetWorker(pytak.Worker):
         ready = asyncio.Event()
 
         await loop.create_datagram_endpoint(
-            lambda: NetListener(self.queue, ready),
+            lambda: NetListener(self.queue, ready, self.capture, self.parser),
             local_addr=(host, port),
         )
         await ready.wait()
@@ -135,8 +585,16 @@ class NetWorker(pytak.Worker):
             await asyncio.sleep(0.01)
 
     async def start_tcp_listener(self, host, port):
-        """Starts a TCP Network Listener."""
-        server = await asyncio.start_server(self.handle_rx, host, port)
+        """
+        Starts a TCP Network Listener.
+
+        Concurrent connections are capped at MAX_CONNECTIONS, each connection's
+        read buffer is capped at MAX_BUFFER bytes, and connections that send
+        nothing for IDLE_TIMEOUT seconds are closed (0 disables the timeout).
+        """
+        server = await asyncio.start_server(
+            self.handle_rx, host, port, limit=self.max_buffer
+        )
 
         addrs = ', '.join(str(sock.getsockname()) for sock in server.sockets)
         self._logger.info(f'Serving on %s', addrs)
@@ -145,145 +603,1639 @@ class NetWorker(pytak.Worker):
             await server.serve_forever()
 
 
+class TypePriorityQueue(asyncio.Queue):
+
+    """
+    An `asyncio.Queue` of CoT Events served by CoT type priority class.
+
+    Events are classified by the longest matching CoT type prefix, lower priority
+    numbers are served first and unmatched types share the lowest class. So
+    lower classes can't starve, once the head of a lower class has waited longer
+    than `max_wait` seconds, one of every `STARVATION_RATIO` gets is served from
+    the longest waiting lower class. When full, the oldest Event of the lowest
+    non-empty class is dropped in favor of an equal or higher priority Event.
+    """
+
+    STARVATION_RATIO: int = 8
+
+    def __init__(
+        self,
+        maxsize: int = 0,
+        classes: Union[dict, None] = None,
+        max_wait: float = cotproxy.DEFAULT_PRIORITY_MAX_WAIT,
+    ) -> None:
+        classes = classes or {}
+        self.classes: list = sorted(
+            classes.items(), key=lambda item: len(item[0]), reverse=True
+        )
+        self.levels: int = max(classes.values(), default=-1) + 2
+        self.max_wait: float = max_wait
+        self.dropped: int = 0
+        self.sojourn: float = 0.0
+        self._streak: int = 0
+        super().__init__(maxsize)
+
+    def _init(self, maxsize):
+        self._queues = [collections.deque() for _ in range(self.levels)]
+        self._size = 0
+
+    def qsize(self) -> int:
+        """Number of Events in the queue, across all classes."""
+        return self._size
+
+    def empty(self) -> bool:
+        """Returns True if the queue is empty."""
+        return not self._size
+
+    def _put(self, item):
+        self._queues[self.priority(item)].append((time.monotonic(), item))
+        self._size += 1
+
+    def _get(self):
+        now: float = time.monotonic()
+        top: int = next(lvl for lvl, queue in enumerate(self._queues) if queue)
+        level: int = top
+
+        aged = [
+            lvl
+            for lvl in range(top + 1, self.levels)
+            if self._queues[lvl] and now - self._queues[lvl][0][0] > self.max_wait
+        ]
+        if aged:
+            self._streak += 1
+            if self._streak >= self.STARVATION_RATIO:
+                self._streak = 0
+                level = min(aged, key=lambda lvl: self._queues[lvl][0][0])
+        else:
+            self._streak = 0
+
+        enqueued, item = self._queues[level].popleft()
+        self._size -= 1
+        self.sojourn = now - enqueued
+        return item
+
+    def priority(self, item) -> int:
+        """Returns the priority class of the given CoT Event."""
+        cot_type: str = item.cot_type or ""
+        for prefix, level in self.classes:
+            if cot_type.startswith(prefix):
+                return level
+        return self.levels - 1
+
+    def put_nowait(self, item) -> None:
+        """Puts an Event on the queue, shedding a lower priority Event if full."""
+        if self.full():
+            level: int = self.priority(item)
+            lower = range(self.levels - 1, level - 1, -1)
+            shed = next((lvl for lvl in lower if self._queues[lvl]), None)
+            if shed is None:
+                raise asyncio.QueueFull
+            self._queues[shed].popleft()
+            self._size -= 1
+            self.dropped += 1
+            self.task_done()
+        super().put_nowait(item)
+
+
+class TrackThinner:
+
+    """
+    Thins position reports of tracks that are barely moving.
+
+    A track's report is forwarded only if it moved more than `distance` meters,
+    turned more than `course` degrees or climbed more than `altitude` meters
+    since the last forwarded report, or `interval` seconds have passed. Only
+    atoms ('a-' types) are thinned. Last forwarded positions are kept per UID in
+    a table of at most `max_tracks` entries, least recently updated are evicted.
+    """
+
+    def __init__(
+        self,
+        interval: float,
+        distance: float = cotproxy.DEFAULT_THIN_DISTANCE,
+        course: float = cotproxy.DEFAULT_THIN_COURSE,
+        altitude: float = cotproxy.DEFAULT_THIN_ALTITUDE,
+        max_tracks: int = cotproxy.DEFAULT_THIN_MAX_TRACKS,
+    ) -> None:
+        self.interval = interval
+        self.distance = distance
+        self.course = course
+        self.altitude = altitude
+        self.max_tracks = max_tracks
+        self.thinned: int = 0
+        self.tracks: collections.OrderedDict = collections.OrderedDict()
+
+    @classmethod
+    def from_config(cls, config) -> Union["TrackThinner", None]:
+        """Returns a `TrackThinner` for the given config, None if disabled."""
+        interval: float = float(
+            config.get("THIN_INTERVAL", cotproxy.DEFAULT_THIN_INTERVAL)
+        )
+        if not interval:
+            return None
+        return cls(
+            interval,
+            float(config.get("THIN_DISTANCE", cotproxy.DEFAULT_THIN_DISTANCE)),
+            float(config.get("THIN_COURSE", cotproxy.DEFAULT_THIN_COURSE)),
+            float(config.get("THIN_ALTITUDE", cotproxy.DEFAULT_THIN_ALTITUDE)),
+            int(config.get("THIN_MAX_TRACKS", cotproxy.DEFAULT_THIN_MAX_TRACKS)),
+        )
+
+    def forward(self, event: CoTEvent) -> bool:
+        """Returns True if the Event should be forwarded, False to thin it."""
+        if event.lat is None or not event.uid or not event.cot_type:
+            return True
+        if not event.cot_type.startswith("a-"):
+            return True
+
+        now: float = event.time if event.time is not None else time.time()
+        last = self.tracks.get(event.uid)
+        if last is not None:
+            lat, lon, hae, course, seen = last
+            if (
+                0 <= now - seen < self.interval
+                and cotproxy.distance(lat, lon, event.lat, event.lon) < self.distance
+                and (
+                    hae is None
+                    or event.hae is None
+                    or abs(event.hae - hae) < self.altitude
+                )
+                and (
+                    course is None
+                    or event.course is None
+                    or abs((event.course - course + 180) % 360 - 180) < self.course
+                )
+            ):
+                self.thinned += 1
+                return False
+            self.tracks.move_to_end(event.uid)
+
+        self.tracks[event.uid] = (event.lat, event.lon, event.hae, event.course, now)
+        if len(self.tracks) > self.max_tracks:
+            self.tracks.popitem(last=False)
+        return True
+
+
+class GeofenceIndex:
+
+    """
+    Polygon geofences from a GeoJSON file, indexed by a uniform lat/lon grid.
+
+    Features whose properties have a 'transform' object are transform fences,
+    that transform is applied to Events inside them. All other features are
+    filter fences, if there are any, Events outside every filter fence are
+    dropped. Each fence is listed in every `cell_size` degree grid cell its
+    bounding box overlaps, so a lookup only tests the fences of one cell.
+    """
+
+    def __init__(
+        self, fences: list, cell_size: float = cotproxy.DEFAULT_GEOFENCE_CELL_SIZE
+    ) -> None:
+        self.cell_size = cell_size
+        self.fences: list = []
+        self.cells: dict = collections.defaultdict(list)
+        self.filtering: bool = False
+        self.dropped: int = 0
+
+        for polygons, transform in fences:
+            positions = [pos for polygon in polygons for pos in polygon[0]]
+            bbox = (
+                min(pos[0] for pos in positions),
+                min(pos[1] for pos in positions),
+                max(pos[0] for pos in positions),
+                max(pos[1] for pos in positions),
+            )
+            self.filtering = self.filtering or transform is None
+            for cell_x in range(self._cell(bbox[0]), self._cell(bbox[2]) + 1):
+                for cell_y in range(self._cell(bbox[1]), self._cell(bbox[3]) + 1):
+                    self.cells[(cell_x, cell_y)].append(len(self.fences))
+            self.fences.append((bbox, polygons, transform))
+
+    @classmethod
+    def from_geojson(
+        cls, path: str, cell_size: float = cotproxy.DEFAULT_GEOFENCE_CELL_SIZE
+    ) -> "GeofenceIndex":
+        """Loads the Polygon & MultiPolygon Features of a GeoJSON file."""
+        with open(path, encoding="UTF-8") as geojson_fd:
+            geojson: dict = json.load(geojson_fd)
+
+        fences: list = []
+        for feature in geojson.get("features", [geojson]):
+            geometry: dict = feature.get("geometry") or {}
+            transform = (feature.get("properties") or {}).get("transform")
+            if geometry.get("type") == "Polygon":
+                fences.append(([geometry["coordinates"]], transform))
+            elif geometry.get("type") == "MultiPolygon":
+                fences.append((geometry["coordinates"], transform))
+        return cls(fences, cell_size)
+
+    def _cell(self, degrees: float) -> int:
+        return math.floor(degrees / self.cell_size)
+
+    def match(self, event: CoTEvent) -> tuple:
+        """
+        Looks up the given Event's position.
+
+        Returns
+        -------
+        `tuple`
+            False if the Event should be dropped, True otherwise, and the
+            transform of the first transform fence it's inside of, or None.
+        """
+        if event.lat is None:
+            return True, None
+
+        admit: bool = not self.filtering
+        transform = None
+        lon, lat = event.lon, event.lat
+        for index in self.cells.get((self._cell(lon), self._cell(lat)), ()):
+            bbox, polygons, fence_tf = self.fences[index]
+            if not bbox[0] <= lon <= bbox[2] or not bbox[1] <= lat <= bbox[3]:
+                continue
+            if admit and (transform or fence_tf is None):
+                continue
+            if any(cotproxy.point_in_polygon(lon, lat, rings) for rings in polygons):
+                if fence_tf is None:
+                    admit = True
+                elif transform is None:
+                    transform = fence_tf
+
+        if not admit:
+            self.dropped += 1
+        return admit, transform
+
+
+class TransformCache:
+
+    """
+    Transforms by COT UID, each cached for `ttl` seconds (0 disables caching).
+
+    UIDs known to have no Transform are cached as None. At most `max_size` UIDs
+    are kept, the least recently stored are evicted first. While `live`, i.e.
+    kept up to date by a `TransformSubscription`, entries don't expire, except
+    those looked up before `mark_unverified()` was last called.
+    """
+
+    def __init__(
+        self,
+        ttl: float = cotproxy.DEFAULT_TF_CACHE_TTL,
+        max_size: int = cotproxy.DEFAULT_TF_CACHE_SIZE,
+    ) -> None:
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries: dict = {}
+        self.live: bool = False
+        self.generation: int = 0
+        self.verified_since: int = 0
+
+    def _fresh(self, entry: tuple, now: float) -> bool:
+        if self.live and entry[2] >= self.verified_since:
+            return True
+        return entry[0] >= now
+
+    def get(self, uid: str) -> tuple:
+        """Returns whether the UID is cached, and its Transform (or None)."""
+        entry = self.entries.get(uid)
+        if entry is None or not self._fresh(entry, time.monotonic()):
+            return False, None
+        return True, entry[1]
+
+    def put(
+        self, uid: str, transform: Union[dict, None], since: Union[int, None] = None
+    ) -> None:
+        """
+        Caches the UID's Transform, None if the UID has no Transform.
+
+        A Transform looked up at `generation` `since` is not cached if a newer
+        one has been pushed since.
+        """
+        if not self.ttl:
+            return
+        entry = self.entries.pop(uid, None)
+        if entry is not None and since is not None and entry[2] > since:
+            self.entries[uid] = entry
+            return
+        generation: int = self.generation if since is None else since
+        self.entries[uid] = (time.monotonic() + self.ttl, transform, generation)
+        if len(self.entries) > self.max_size:
+            del self.entries[next(iter(self.entries))]
+
+    def push(self, uid: str, transform: Union[dict, None]) -> None:
+        """Caches a change pushed by COTProxyWeb, outdating lookups in flight."""
+        self.generation += 1
+        self.put(uid, transform)
+
+    def snapshot(self) -> dict:
+        """Returns the unexpired Transforms (or None) by UID."""
+        now: float = time.monotonic()
+        return {
+            uid: entry[1]
+            for uid, entry in self.entries.items()
+            if self._fresh(entry, now)
+        }
+
+    def mark_unverified(self) -> None:
+        """
+        Marks the Transforms cached so far as unverified by the change stream,
+        e.g. those restored from a snapshot, so they still expire while live.
+        """
+        self.generation += 1
+        self.verified_since = self.generation
+
+    def clear(self) -> None:
+        """Forgets all cached Transforms."""
+        self.generation += 1
+        self.entries.clear()
+
+    def restore(self, transforms: dict) -> None:
+        """Caches Transforms (or None) by UID, e.g. from a snapshot."""
+        for uid, transform in transforms.items():
+            self.put(uid, transform)
+
+
+class TransformLookup:
+
+    """
+    Looks up Transforms, micro-batching cache misses.
+
+    Misses are gathered for up to `window` seconds (or `batch_size` UIDs) and
+    fetched with one POST of their UIDs to `batch_path`. If COTProxyWeb
+    doesn't have that endpoint, misses fall back to concurrent `GET /tf/{uid}`.
+    A UID whose lookup fails raises `LookupError` and isn't cached, without
+    failing the other UIDs of its batch.
+    """
+
+    _logger = logging.getLogger(__name__)
+
+    def __init__(
+        self,
+        session: aiohttp.ClientSession,
+        cache: TransformCache,
+        window: float = cotproxy.DEFAULT_LOOKUP_WINDOW,
+        batch_size: int = cotproxy.DEFAULT_LOOKUP_BATCH,
+        batch_path: str = cotproxy.DEFAULT_CPAPI_BATCH_PATH,
+    ) -> None:
+        self.session = session
+        self.cache = cache
+        self.window = window
+        self.batch_size = batch_size
+        self.batch_path = batch_path
+        self.batch_supported: bool = bool(batch_path)
+        self.pending: dict = {}
+        self._timer = None
+
+    async def get(self, uid: str) -> Union[dict, None]:
+        """
+        Returns the UID's Transform, or None if it doesn't have one.
+
+        Raises
+        ------
+        `LookupError`
+            If the UID's Transform couldn't be looked up.
+        """
+        hit, transform = self.cache.get(uid)
+        if hit:
+            return transform
+
+        future = self.pending.get(uid)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = self.pending[uid] = loop.create_future()
+            if len(self.pending) >= self.batch_size:
+                self.flush()
+            elif self._timer is None:
+                self._timer = loop.call_later(self.window, self.flush)
+        return await asyncio.shield(future)
+
+    def flush(self) -> None:
+        """Fetches all pending misses."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        pending, self.pending = self.pending, {}
+        if pending:
+            asyncio.ensure_future(self._fetch(pending))
+
+    async def _fetch(self, pending: dict) -> None:
+        since: int = self.cache.generation
+        try:
+            results: dict = await self.fetch_many(list(pending))
+        except Exception as exc:  # pylint: disable=broad-except
+            self._logger.warning("Transform lookup failed: %s", exc)
+            results = {}
+
+        for uid, future in pending.items():
+            if future.done():
+                continue
+            if uid not in results:
+                future.set_exception(LookupError(f"{uid} Transform lookup failed"))
+                continue
+            self.cache.put(uid, results[uid], since)
+            future.set_result(results[uid])
+
+    async def refresh(self, uids: list) -> None:
+        """Re-fetches the Transforms of the given UIDs into the cache."""
+        since: int = self.cache.generation
+        results: dict = await self.fetch_many(uids)
+        for uid, transform in results.items():
+            self.cache.put(uid, transform, since)
+
+    async def fetch_many(self, uids: list) -> dict:
+        """
+        Fetches Transforms by UID, batched if COTProxyWeb supports it.
+
+        Returns
+        -------
+        `dict`
+            Transforms (or None) by UID, UIDs whose lookup failed are absent.
+        """
+        if len(uids) > 1 and self.batch_supported:
+            try:
+                results = await self.fetch_batch(uids)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+                # Perhaps due to one of the UIDs, look each up on its own:
+                self._logger.warning("Batched Transform lookup failed: %s", exc)
+                results = None
+            if results is not None:
+                return {uid: results.get(uid) for uid in uids}
+
+        transforms = await asyncio.gather(
+            *(self.fetch(uid) for uid in uids), return_exceptions=True
+        )
+        results = {}
+        for uid, transform in zip(uids, transforms):
+            if isinstance(transform, Exception):
+                self._logger.warning("%s Transform lookup failed: %s", uid, transform)
+            else:
+                results[uid] = transform
+        return results
+
+    async def fetch(self, uid: str) -> Union[dict, None]:
+        """Fetches a single UID's Transform, None if it doesn't have one."""
+        async with self.session.get(f"/tf/{uid}") as response:
+            if response.status == 404:
+                return None
+            response.raise_for_status()
+            return await response.json()
+
+    async def fetch_batch(self, uids: list) -> Union[dict, None]:
+        """
+        Fetches the Transforms of many UIDs at once.
+
+        Returns
+        -------
+        `dict`
+            Transforms by UID, UIDs without a Transform are absent. None if
+            COTProxyWeb doesn't support batched lookups.
+        """
+        async with self.session.post(self.batch_path, json={"uids": uids}) as response:
+            if response.status in (404, 405, 501):
+                self.batch_supported = False
+                return None
+            response.raise_for_status()
+            transforms = await response.json()
+
+        if isinstance(transforms, dict):
+            return transforms
+        return {transform.get("cot_uid"): transform for transform in transforms}
+
+
+class TransformSubscription:
+
+    """
+    Keeps a `TransformCache` up to date from COTProxyWeb's Transform change stream.
+
+    Subscribes to `path` as Server-Sent Events, where 'insert', 'update' &
+    'delete' events carry the changed Transform (or its `cot_uid`) as JSON,
+    and 'reset' invalidates the whole cache. The cache is `live` while
+    subscribed. Reconnects resume from the last event ID received, a server
+    unable to resume from it should send 'reset'. Connecting without an event
+    ID to resume from marks the cache unverified, as changes to what's cached
+    may have been missed. While the stream is unavailable the cache falls back
+    to expiring entries after their TTL.
+    """
+
+    _logger = logging.getLogger(__name__)
+
+    # Seconds before retrying a COTProxyWeb without a change stream:
+    UNSUPPORTED_RETRY: float = 300.0
+    MAX_BACKOFF: float = 60.0
+
+    def __init__(
+        self,
+        session: aiohttp.ClientSession,
+        cache: TransformCache,
+        path: str = cotproxy.DEFAULT_CPAPI_EVENTS_PATH,
+        timeout: float = cotproxy.DEFAULT_SUBSCRIBE_TIMEOUT,
+    ) -> None:
+        self.session = session
+        self.cache = cache
+        self.path = path
+        self.timeout = timeout
+        self.last_id: Union[str, None] = None
+        self.retry: float = 1.0
+        self.events: int = 0
+
+    async def run(self) -> None:
+        """Subscribes to the change stream, reconnecting whenever it ends."""
+        backoff: float = self.retry
+        while 1:
+            received: int = self.events
+            try:
+                if not await self.subscribe():
+                    self._logger.info(
+                        "No Transform change stream at '%s', using TTL", self.path
+                    )
+                    await asyncio.sleep(self.UNSUPPORTED_RETRY)
+                    continue
+            except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+                self._logger.warning("Transform change stream failed: %s", exc)
+            except Exception:  # pylint: disable=broad-except
+                # e.g. a malformed change, this task must keep the cache current:
+                self._logger.exception("Transform change stream failed")
+            finally:
+                self.cache.live = False
+
+            backoff = self.retry if self.events > received else backoff * 2
+            backoff = min(backoff, self.MAX_BACKOFF)
+            await asyncio.sleep(backoff)
+
+    async def subscribe(self) -> bool:
+        """
+        Applies changes from the stream until it ends.
+
+        Returns
+        -------
+        `bool`
+            False if COTProxyWeb doesn't have a change stream.
+        """
+        headers: dict = {"Accept": "text/event-stream"}
+        if self.last_id is not None:
+            headers["Last-Event-ID"] = self.last_id
+        timeout = aiohttp.ClientTimeout(total=None, sock_read=self.timeout)
+
+        async with self.session.get(
+            self.path, headers=headers, timeout=timeout
+        ) as response:
+            if response.status in (404, 405, 501):
+                return False
+            response.raise_for_status()
+            if self.last_id is None:
+                # Changes to what's cached may have been missed, so it expires:
+                self.cache.mark_unverified()
+            self.cache.live = True
+            self._logger.info("Subscribed to Transform changes at '%s'", self.path)
+
+            event_type, data, event_id = "message", [], None
+            async for raw_line in response.content:
+                line: str = raw_line.decode().rstrip("\r\n")
+                if not line:
+                    if data:
+                        self.apply(event_type, "\n".join(data))
+                    if event_id is not None:
+                        self.last_id = event_id
+                    event_type, data, event_id = "message", [], None
+                    continue
+                if line.startswith(":"):
+                    continue
+                field, _, value = line.partition(":")
+                value = value[1:] if value.startswith(" ") else value
+                if field == "event":
+                    event_type = value
+                elif field == "data":
+                    data.append(value)
+                elif field == "id":
+                    event_id = value
+                elif field == "retry" and value.isdigit():
+                    self.retry = int(value) / 1000
+        return True
+
+    def apply(self, event_type: str, data: str) -> None:
+        """Applies a single change event to the cache."""
+        self.events += 1
+        if event_type == "reset":
+            self.cache.clear()
+            return
+        change = json.loads(data)
+        if event_type in ("insert", "update"):
+            self.cache.push(change["cot_uid"], change)
+        elif event_type == "delete":
+            uid: str = change["cot_uid"] if isinstance(change, dict) else change
+            self.cache.push(uid, None)
+
+
+class LoadShedder:
+
+    """
+    Degrades transforming in steps while `tf_queue` sojourn time exceeds `target`.
+
+    Modes, from least to most degraded:
+    - NORMAL: Transforms are looked up in the cache, then COTProxyWeb.
+    - CACHE_ONLY: Only cached Transforms are applied, nothing is fetched or added.
+    - PASS_THROUGH: Events are passed on as received, regardless of PASS_ALL.
+    - DROP_LOW: As PASS_THROUGH, and the lowest priority class is dropped.
+
+    The (smoothed) sojourn time is checked at most every `hold` seconds, moving
+    one mode up while it is over `target`, and one mode back down once it is
+    under half of `target`.
+    """
+
+    NORMAL: int = 0
+    CACHE_ONLY: int = 1
+    PASS_THROUGH: int = 2
+    DROP_LOW: int = 3
+    MODES: tuple = ("NORMAL", "CACHE_ONLY", "PASS_THROUGH", "DROP_LOW")
+
+    # Weight of each new sojourn sample:
+    ALPHA: float = 0.2
+    # Fraction of target the sojourn must fall under to recover:
+    RECOVER_RATIO: float = 0.5
+
+    def __init__(self, target: float, hold: float = cotproxy.DEFAULT_SHED_HOLD):
+        self.target = target
+        self.hold = hold
+        self.mode: int = self.NORMAL
+        self.sojourn: float = 0.0
+        self.changed: float = float("-inf")
+
+    @classmethod
+    def from_config(cls, config) -> Union["LoadShedder", None]:
+        """Returns a `LoadShedder` for the given config, None if disabled."""
+        target: float = float(config.get("SHED_TARGET", cotproxy.DEFAULT_SHED_TARGET))
+        if not target:
+            return None
+        return cls(target, float(config.get("SHED_HOLD", cotproxy.DEFAULT_SHED_HOLD)))
+
+    @property
+    def name(self) -> str:
+        """Name of the current mode."""
+        return self.MODES[self.mode]
+
+    def update(self, sojourn: float) -> bool:
+        """Accounts for a sojourn time sample, returns True if the mode changed."""
+        self.sojourn += self.ALPHA * (sojourn - self.sojourn)
+        now: float = time.monotonic()
+        if now - self.changed < self.hold:
+            return False
+        if self.sojourn > self.target and self.mode < self.DROP_LOW:
+            self.mode += 1
+        elif self.sojourn < self.target * self.RECOVER_RATIO and self.mode:
+            self.mode -= 1
+        else:
+            return False
+        self.changed = now
+        return True
+
+
+@dataclass(frozen=True)
+class ProxySettings:
+
+    """
+    Immutable snapshot of the settings `COTProxyWorker` reads for every Event.
+
+    Parsed once from the config, so the hot path never goes through
+    `ConfigParser` interpolation. Swapped as a whole on reload.
+    """
+
+    pass_all: bool = cotproxy.DEFAULT_PASS_ALL
+    auto_add: bool = cotproxy.DEFAULT_AUTO_ADD
+    drop_stale: bool = cotproxy.DEFAULT_DROP_STALE
+    stats_interval: int = cotproxy.DEFAULT_STATS_INTERVAL
+
+    @classmethod
+    def from_config(cls, config) -> "ProxySettings":
+        """Parses a `ProxySettings` from the given config section."""
+        return cls(
+            pass_all=config.getboolean("PASS_ALL", cotproxy.DEFAULT_PASS_ALL),
+            auto_add=config.getboolean("AUTO_ADD", cotproxy.DEFAULT_AUTO_ADD),
+            drop_stale=config.getboolean("DROP_STALE", cotproxy.DEFAULT_DROP_STALE),
+            stats_interval=int(
+                config.get("STATS_INTERVAL", cotproxy.DEFAULT_STATS_INTERVAL)
+            ),
+        )
+
+
+# Settings reloaded by CONFIG_FILE, kept across reconnects of `create_tasks()`:
+RELOADED_SETTINGS: dict = {}
+
+
 class COTProxyWorker(pytak.QueueWorker):
     """
     Pops unmodified COT from a TF Queue, transforms it if needed, and puts it
     back onto a TX Queue.
     """
 
-    def __init__(self, queue: asyncio.Queue, config, tf_queue: asyncio.Queue) -> None:
+    def __init__(
+        self,
+        queue: asyncio.Queue,
+        config,
+        tf_queue: asyncio.Queue,
+        auto_add_queue: Union[asyncio.Queue, None] = None,
+        pool: Union[concurrent.futures.Executor, None] = None,
+    ) -> None:
         super().__init__(queue, config)
         self.tf_queue = tf_queue
+        self.auto_add_queue = auto_add_queue
+        self.renderer: Union[PoolBatcher, None] = None
+        if pool is not None:
+            self.renderer = PoolBatcher(
+                pool,
+                cotproxy.render_transform,
+                int(self.config.get("POOL_BATCH", cotproxy.DEFAULT_POOL_BATCH)),
+            )
         self.session = None
+        self.lookup: Union[TransformLookup, None] = None
+        self.cache = TransformCache(
+            float(self.config.get("TF_CACHE_TTL", cotproxy.DEFAULT_TF_CACHE_TTL)),
+            int(self.config.get("TF_CACHE_SIZE", cotproxy.DEFAULT_TF_CACHE_SIZE)),
+        )
+        # Iconset paths by Icon, cached & bounded like Transforms:
+        self.icons = TransformCache(self.cache.ttl, self.cache.max_size)
+        self.cache_file: str = self.config.get(
+            "CACHE_FILE", cotproxy.DEFAULT_CACHE_FILE
+        )
+        self.batch_size: int = int(
+            self.config.get("LOOKUP_BATCH", cotproxy.DEFAULT_LOOKUP_BATCH)
+        )
+        self.settings: ProxySettings = RELOADED_SETTINGS.get(
+            self.config.get("CONFIG_FILE", "config.ini")
+        ) or ProxySettings.from_config(self.config)
+        self.thinner: Union[TrackThinner, None] = TrackThinner.from_config(self.config)
+        self.shedder: Union[LoadShedder, None] = LoadShedder.from_config(self.config)
+        self.geofences: Union[GeofenceIndex, None] = None
+        geofence_file: str = self.config.get(
+            "GEOFENCE_FILE", cotproxy.DEFAULT_GEOFENCE_FILE
+        )
+        if geofence_file:
+            self.geofences = GeofenceIndex.from_geojson(
+                geofence_file,
+                float(
+                    self.config.get(
+                        "GEOFENCE_CELL_SIZE", cotproxy.DEFAULT_GEOFENCE_CELL_SIZE
+                    )
+                ),
+            )
+        self.stats: dict = {
+            "events": 0,
+            "stale": 0,
+            "shed": 0,
+            "lag": 0.0,
+            "max_lag": 0.0,
+        }
+        self._stats_reported: float = time.monotonic()
 
     async def run(self, number_of_iterations=-1) -> None:
         """Runs this Thread."""
         cpapi_url: str = self.config.get("CPAPI_URL", cotproxy.DEFAULT_CPAPI_URL)
         self._logger.info("%s using: %s", self.__class__, cpapi_url)
 
-        async with aiohttp.ClientSession(cpapi_url) as self.session:
-            while 1:
-                try:
-                    await self.read_queue(use_proxy=True)
-                except Exception as exc:
-                    self._logger.warning(
-                        "Connection to '%s' raised an error: %s", cpapi_url, exc
-                    )
-                    self._logger.debug(exc)
-                    # FIXME: Change to backoff.
-                    await asyncio.sleep(2)
+        loop = asyncio.get_running_loop()
+        try:
+            loop.add_signal_handler(signal.SIGHUP, self.reload)
+        except (AttributeError, NotImplementedError):
+            self._logger.debug("SIGHUP reload not supported on this platform.")
+
+        restored: list = self.load_cache()
+
+        async with cotproxy.cpapi_session(self.config) as self.session:
+            self.lookup = TransformLookup(
+                self.session,
+                self.cache,
+                float(self.config.get("LOOKUP_WINDOW", cotproxy.DEFAULT_LOOKUP_WINDOW)),
+                self.batch_size,
+                self.config.get("CPAPI_BATCH_PATH", cotproxy.DEFAULT_CPAPI_BATCH_PATH),
+            )
+            tasks: list = []
+            events_path: str = self.config.get(
+                "CPAPI_EVENTS_PATH", cotproxy.DEFAULT_CPAPI_EVENTS_PATH
+            )
+            if events_path and self.cache.ttl:
+                subscription = TransformSubscription(
+                    self.session,
+                    self.cache,
+                    events_path,
+                    float(
+                        self.config.get(
+                            "SUBSCRIBE_TIMEOUT", cotproxy.DEFAULT_SUBSCRIBE_TIMEOUT
+                        )
+                    ),
+                )
+                tasks.append(asyncio.ensure_future(subscription.run()))
+            if self.cache_file:
+                tasks.append(asyncio.ensure_future(self.revalidate(restored)))
+                tasks.append(asyncio.ensure_future(self.save_cache_periodically()))
+            try:
+                while 1:
+                    try:
+                        await self.read_queue(use_proxy=True)
+                    except Exception as exc:
+                        self._logger.warning(
+                            "Connection to '%s' raised an error: %s", cpapi_url, exc
+                        )
+                        self._logger.debug(exc)
+                        # FIXME: Change to backoff.
+                        await asyncio.sleep(2)
+            finally:
+                for task in tasks:
+                    task.cancel()
+                self.save_cache()
+
+    def load_cache(self) -> list:
+        """
+        Warms the Transform & icon caches from the CACHE_FILE snapshot, if any.
+
+        Restored Transforms are served right away, and revalidated against
+        COTProxyWeb in the background by `revalidate()`.
+
+        Returns
+        -------
+        `list`
+            UIDs restored from the snapshot.
+        """
+        if not self.cache_file or not os.path.exists(self.cache_file):
+            return []
+        try:
+            snapshot: dict = cotproxy.load_cache_snapshot(self.cache_file)
+        except (OSError, ValueError) as exc:
+            self._logger.warning("Ignoring cache '%s': %s", self.cache_file, exc)
+            return []
+
+        transforms: dict = snapshot.get("transforms", {})
+        self.cache.restore(transforms)
+        icons: dict = snapshot.get("icons", {})
+        self.icons.restore(icons)
+        self._logger.info(
+            "Restored %s Transforms & %s icons from '%s'",
+            len(transforms),
+            len(icons),
+            self.cache_file,
+        )
+        return list(transforms)
+
+    def save_cache(self) -> None:
+        """Snapshots the Transform & icon caches to CACHE_FILE, if set."""
+        if not self.cache_file:
+            return
+        snapshot: dict = {
+            "saved": time.time(),
+            "transforms": self.cache.snapshot(),
+            "icons": self.icons.snapshot(),
+        }
+        try:
+            size: int = cotproxy.save_cache_snapshot(self.cache_file, snapshot)
+        except OSError as exc:
+            self._logger.warning("Unable to save cache '%s': %s", self.cache_file, exc)
+            return
+        self._logger.debug("Saved %s bytes of cache to '%s'", size, self.cache_file)
+
+    async def save_cache_periodically(self) -> None:
+        """Snapshots the caches every CACHE_SAVE_INTERVAL seconds."""
+        interval: int = int(
+            self.config.get("CACHE_SAVE_INTERVAL", cotproxy.DEFAULT_CACHE_SAVE_INTERVAL)
+        )
+        if not interval:
+            return
+        while 1:
+            await asyncio.sleep(interval)
+            self.save_cache()
+
+    async def revalidate(self, uids: list) -> None:
+        """
+        Re-fetches the Transforms of restored UIDs a batch at a time, then the
+        iconset paths of the cached icons.
+        """
+        icons: list = list(self.icons.snapshot())
+        try:
+            for start in range(0, len(uids), self.batch_size):
+                await self.lookup.refresh(uids[start : start + self.batch_size])
+            for icon in icons:
+                await self.fetch_icon(icon)
+        except Exception as exc:
+            self._logger.warning("Stopped revalidating cache: %s", exc)
+            return
+        if uids or icons:
+            self._logger.info(
+                "Revalidated %s restored Transforms & %s icons", len(uids), len(icons)
+            )
+
+    def reload(self) -> None:
+        """Swaps in a new settings snapshot read from CONFIG_FILE, e.g. on SIGHUP."""
+        config_file: str = self.config.get("CONFIG_FILE", "config.ini")
+        try:
+            settings = ProxySettings.from_config(cotproxy.load_config(config_file))
+        except Exception as exc:
+            self._logger.error("Not reloading '%s': %s", config_file, exc)
+            return
+        self.settings = settings
+        RELOADED_SETTINGS[config_file] = settings
+        self._logger.info("Reloaded '%s': %s", config_file, settings)
 
     async def read_queue(self, use_proxy: bool = True) -> None:
-        """Reads COT from ingress queue and hands off to COT handler."""
-        tf_msg: ET.Element = await self.tf_queue.get()
-        self._logger.debug('Got tf_msg="%s"', ET.tostring(tf_msg))
-        if tf_msg:
-            await self.handle_data(tf_msg, use_proxy)
+        """
+        Reads COT from ingress queue and hands off to COT handler.
 
-    async def create_co_and_tf(self, event: ET.Element) -> None:
+        Up to LOOKUP_BATCH Events already waiting are read at once and handled
+        concurrently, so their Transform lookups can share a batch. Events with
+        the same UID are still handled in the order they were received.
         """
-        Creates a COTObject & Transform with the given Event, if neither CO or TF exist.
+        events: list = [await self.tf_queue.get()]
+        while len(events) < self.batch_size and not self.tf_queue.empty():
+            events.append(self.tf_queue.get_nowait())
+
+        mode: int = self.shed_load()
+
+        by_uid: dict = {}
+        for tf_msg in events:
+            self._logger.debug('Got tf_msg="%s"', tf_msg.raw)
+            if (
+                tf_msg is not None
+                and not self.is_stale(tf_msg)
+                and not (mode == LoadShedder.DROP_LOW and self.is_low(tf_msg))
+                and (self.thinner is None or self.thinner.forward(tf_msg))
+            ):
+                by_uid.setdefault(tf_msg.uid, []).append(tf_msg)
+
+        results = await asyncio.gather(
+            *(self.handle_uid(uid_events, use_proxy) for uid_events in by_uid.values()),
+            return_exceptions=True,
+        )
+        self.report_stats()
+        # An error handling one UID's Events mustn't hold up the others':
+        for uid, result in zip(by_uid, results):
+            if isinstance(result, Exception):
+                self._logger.error("%s Event handling failed: %r", uid, result)
+
+    def shed_load(self) -> int:
+        """Updates the load shedding mode from `tf_queue` sojourn time, if enabled."""
+        if self.shedder is None:
+            return LoadShedder.NORMAL
+        previous: str = self.shedder.name
+        if self.shedder.update(getattr(self.tf_queue, "sojourn", 0.0)):
+            log = self._logger.warning if self.shedder.mode else self._logger.info
+            log(
+                "Load shedding %s -> %s: sojourn=%.3fs target=%.3fs",
+                previous,
+                self.shedder.name,
+                self.shedder.sojourn,
+                self.shedder.target,
+            )
+        return self.shedder.mode
+
+    def is_low(self, event: CoTEvent) -> bool:
+        """Determines if the Event is of the lowest priority class, to be shed."""
+        priority = getattr(self.tf_queue, "priority", None)
+        if priority is None or priority(event) < self.tf_queue.levels - 1:
+            return False
+        self.stats["shed"] += 1
+        return True
+
+    async def handle_uid(self, events: list, use_proxy: bool = True) -> None:
+        """Handles Events of the same UID, in order."""
+        for event in events:
+            await self.handle_data(event, use_proxy)
+
+    def is_stale(self, event: CoTEvent) -> bool:
         """
-        uid: str = event.attrib.get("uid")
-        callsign: str = cotproxy.get_callsign(event)
-        remarks: str = event.find("detail").find("remarks")
+        Records the Event's lag and determines if it is already past its stale time.
 
-        if not uid:
+        Stale Events are dropped before any COTProxy API lookup when DROP_STALE is
+        True, letting a backed-up `tf_queue` catch up quickly.
+        """
+        now: float = time.time()
+        self.stats["events"] += 1
+
+        if event.time is not None:
+            lag: float = now - event.time
+            self.stats["lag"] = 0.9 * self.stats["lag"] + 0.1 * lag
+            self.stats["max_lag"] = max(self.stats["max_lag"], lag)
+
+        if not self.settings.drop_stale:
+            return False
+
+        if event.stale is not None and event.stale < now:
+            self.stats["stale"] += 1
+            self._logger.debug("%s is stale, dropping.", event.uid)
+            return True
+        return False
+
+    def report_stats(self) -> None:
+        """Logs pipeline metrics every STATS_INTERVAL seconds."""
+        now: float = time.monotonic()
+        interval: int = self.settings.stats_interval
+        if not interval or now - self._stats_reported < interval:
+            return
+        self._stats_reported = now
+        self._logger.info(
+            "events=%s stale=%s thinned=%s fenced=%s lag=%.3fs max_lag=%.3fs "
+            "backlog=%s shed=%s mode=%s",
+            self.stats["events"],
+            self.stats["stale"],
+            self.thinner.thinned if self.thinner else 0,
+            self.geofences.dropped if self.geofences else 0,
+            self.stats["lag"],
+            self.stats["max_lag"],
+            self.tf_queue.qsize(),
+            getattr(self.tf_queue, "dropped", 0) + self.stats["shed"],
+            self.shedder.name if self.shedder else LoadShedder.MODES[0],
+        )
+        self.stats["max_lag"] = 0.0
+
+    async def create_co_and_tf(self, event: CoTEvent) -> None:
+        """
+        Queues creation of a COTObject & Transform with the given Event, if AUTO_ADD.
+
+        Creation is done in the background by `AutoAddWorker`, so the Event
+        (and every Event behind it) never waits on the COTProxy API.
+        """
+        if not event.uid:
             self._logger.debug("Event had no UID, returning.")
             return
 
-        auto_add: bool = self.config.getboolean("AUTO_ADD", cotproxy.DEFAULT_AUTO_ADD)
-        if auto_add:
-            self._logger.info("%s added (AUTO_ADD=%s)", uid, auto_add)
-
-            # Create a COT Object
-            co_url: str = "/co/"
-            async with self.session.post(co_url, json={"uid": uid}) as resp:
-                self._logger.debug("%s call status: %s", co_url, resp.status)
-
-            if callsign:
-                # Populate the transform
-                tf_url: str = "/tf/"
-                tf_payload = {
-                    "cot_uid": uid,
-                    "cot_type": event.attrib.get("type"),
-                    "callsign": callsign,
-                }
-                if remarks:
-                    tf_payload["remarks"] = remarks.text
-                else:
-                    tf_payload["remarks"] = None
-
-                async with self.session.post(tf_url, json=tf_payload) as resp:
-                    self._logger.debug("%s call status: %s", tf_url, resp.status)
-
-    async def transform_event(self, event: ET.Element, transform: dict) -> None:
+        if self.settings.auto_add and self.auto_add_queue is not None:
+            try:
+                self.auto_add_queue.put_nowait(event)
+            except asyncio.QueueFull:
+                self._logger.debug("AUTO_ADD queue full, skipping %s", event.uid)
+
+    async def transform_event(
+        self, event: CoTEvent, transform: dict
+    ) -> Union[bytes, None]:
         """
         Transforms a COT event using the given transform.
 
         Parameters
         ----------
-        event : `xml.etree.ElementTree.Element`
+        event : `cotproxy.CoTEvent`
             Incoming COT event to transform.
         transform : `dict`
             Data struct of transforms to apply to event.
+
+        Returns
+        -------
+        `bytes`
+            The COT event sent, None if it was dropped.
         """
-        if transform.get("active", False):
-            self._logger.info("%s Transforming", event.attrib.get("uid"))
-            icon = transform.get("icon")
-            if icon:
-                transform["icon"] = await self.get_icon(icon)
-            event: ET.Element = cotproxy.transform_cot(event, transform)
+        if not transform.get("active", False):
+            await self.put_queue(event.raw)
+            return event.raw
 
-        if isinstance(event, ET.Element):
-            await self.put_queue(ET.tostring(event))
-        else:
-            self._logger.warning("Incoming event was not ET.Element")
+        self._logger.info("%s Transforming", event.uid)
+        icon = transform.get("icon")
+        if icon:
+            transform = dict(transform, icon=await self.get_icon(icon))
+        job: tuple = (event.raw, transform)
+        try:
+            if self.renderer is not None:
+                # Handled in order per UID, as each UID's Events are awaited in turn:
+                transformed: bytes = await self.renderer.submit(job)
+            else:
+                transformed = cotproxy.render_transform(job)
+        except ET.ParseError as exc:
+            # Rather than pass it on untransformed:
+            self._logger.warning("%s Dropped malformed Event: %s", event.uid, exc)
+            return None
+        except (AttributeError, ValueError) as exc:
+            # e.g. a callsign Transform of an Event without a contact:
+            self._logger.warning("%s Dropped untransformable Event: %r", event.uid, exc)
+            return None
+        await self.put_queue(transformed)
+        return transformed
+
+    async def get_icon(self, icon) -> Union[str, None]:
+        """Returns the iconsetpath of the given Icon, cached for TF_CACHE_TTL."""
+        cached, path = self.icons.get(icon)
+        if cached:
+            return path
+        return await self.fetch_icon(icon)
 
-    async def get_icon(self, icon) -> None:
+    async def fetch_icon(self, icon) -> Union[str, None]:
+        """Fetches & caches the iconsetpath of the given Icon, None if not found."""
         endpoint: str = f"/icon/{icon}"
         async with self.session.get(endpoint) as response:
-            if response.status == 200:
+            if response.status == 404:
+                self.icons.put(icon, None)
+            elif response.status == 200:
                 resp = await response.json()
                 iconset_uuid = resp["iconset"]
                 endpoint = f"/iconset/{iconset_uuid}"
                 async with self.session.get(endpoint) as response:
                     resp = await response.json()
-                    return f"{iconset_uuid}/{resp['name']}/{icon}"
-                
-    async def handle_data(self, data: ET.Element, use_proxy: bool = True) -> None:
+                    path: str = f"{iconset_uuid}/{resp['name']}/{icon}"
+                    self.icons.put(icon, path)
+                    return path
+        return None
+
+    async def handle_data(self, data: CoTEvent, use_proxy: bool = True) -> None:
         """
         Handles data from a queue. In this case, that data is unprocessed COT Events.
 
         If the Event's UID:
         - Matches an existing Transform: Hand Event off to `transform_event()`.
         - Does not match an existing Transform: Hand Event off to `create_co_and_tf()`.
+        Events outside of the geofences are dropped before any lookup, and
+        geofence transforms are applied beneath the Event's own Transform.
+        While shedding load, only cached Transforms are applied, or none at all
+        with Events passed on as received.
         Finally, the Event will get handed-off to `pass_all()`.
 
         Parameters
         ----------
-        data : `xml.etree.ElementTree.Element`
+        data : `cotproxy.CoTEvent`
             An unprocessed Cursor-On-Target Event.
         use_proxy : `bool`
             Determines if we should even query the COTProxy API.
         """
-        uid: str = data.attrib.get("uid")
+        uid: str = data.uid
         if not uid:
             self._logger.debug("Event had no UID, returning.")
             return
 
-        if use_proxy:
-            tf_url: str = f"/tf/{uid}"
-            async with self.session.get(tf_url) as response:
+        fence_tf = None
+        if self.geofences:
+            admit, fence_tf = self.geofences.match(data)
+            if not admit:
+                self._logger.debug("%s is outside of the geofences, dropping.", uid)
+                return
+
+        if self.shedder and self.shedder.mode >= LoadShedder.PASS_THROUGH:
+            # Shedding load, pass on as received regardless of PASS_ALL:
+            await self.put_queue(data.raw)
+            return
+
+        transform = None
+        if use_proxy and self.shedder and self.shedder.mode:
+            # Shedding load, only apply Transforms that are already cached:
+            _, transform = self.cache.get(uid)
+        elif use_proxy:
+            try:
+                transform = await self.lookup.get(uid)
+            except LookupError as exc:
+                # Handled as if without a Transform, but not added:
+                self._logger.debug(exc)
+            else:
                 # If a Transform for this COT UID doesn't exist:
-                if response.status == 404:
+                if transform is None:
                     await self.create_co_and_tf(data)
-                # If a Transform for this COT UID does exist, try to Transform:
-                elif response.status == 200:
-                    await self.transform_event(data, await response.json())
-        await self.pass_all(data)
-
-    async def pass_all(self, event: ET.ElementTree) -> None:
-        """Passes non-transformed COT Events, if self.pass_all is True."""
-        if self.config.getboolean("PASS_ALL", cotproxy.DEFAULT_PASS_ALL):
-            await self.put_queue(ET.tostring(event))
+
+        if fence_tf:
+            # The Event's own active Transform takes precedence over the geofence's:
+            own: dict = transform if transform and transform.get("active") else {}
+            transform = {**fence_tf, **{key: val for key, val in own.items() if val}}
+            transform["active"] = True
+
+        if transform is None:
+            await self.pass_all(data)
+            return
+        sent = await self.transform_event(data, transform)
+        if sent is not None:
+            await self.pass_all(data, sent)
+
+    async def pass_all(self, event: CoTEvent, sent: Union[bytes, None] = None) -> None:
+        """
+        Passes COT Events, if self.pass_all is True.
+
+        Events handed-off to `transform_event()` are passed again as they were
+        sent, transformed or not.
+        """
+        if self.settings.pass_all:
+            await self.put_queue(event.raw if sent is None else sent)
+
+
+class AutoAddWorker(pytak.Worker):
+
+    """
+    Write-behind creation of COTObjects & Transforms for AUTO_ADD.
+
+    Collects newly seen Events from the AUTO_ADD queue for up to
+    AUTO_ADD_WINDOW seconds (or AUTO_ADD_BATCH UIDs), de-duplicates them by UID
+    and creates each batch concurrently, retrying failed calls with backoff.
+    """
+
+    # UIDs already added, remembered so repeated lookup misses don't re-add them.
+    MAX_ADDED: int = 100000
+    RETRY_BACKOFF: float = 0.5
+
+    def __init__(self, queue: asyncio.Queue, config) -> None:
+        super().__init__(queue, config)
+        self.session = None
+        self.added: collections.OrderedDict = collections.OrderedDict()
+        self.window: float = float(
+            self.config.get("AUTO_ADD_WINDOW", cotproxy.DEFAULT_AUTO_ADD_WINDOW)
+        )
+        self.batch_size: int = int(
+            self.config.get("AUTO_ADD_BATCH", cotproxy.DEFAULT_AUTO_ADD_BATCH)
+        )
+        self.retries: int = int(
+            self.config.get("AUTO_ADD_RETRIES", cotproxy.DEFAULT_AUTO_ADD_RETRIES)
+        )
+
+    async def run(self, number_of_iterations=-1) -> None:
+        """Runs this Thread."""
+        async with cotproxy.cpapi_session(self.config) as self.session:
+            while 1:
+                batch: dict = await self.collect()
+                try:
+                    await self.flush(batch)
+                except Exception:  # pylint: disable=broad-except
+                    # AUTO_ADD is best effort, it must never take down the proxy:
+                    self._logger.exception("Adding batch of %s failed", len(batch))
+
+    async def collect(self) -> dict:
+        """Collects a batch of Events to add, keyed (and so de-duplicated) by UID."""
+        loop = asyncio.get_running_loop()
+        event: CoTEvent = await self.queue.get()
+        batch: dict = {event.uid: event}
+        deadline: float = loop.time() + self.window
+        while len(batch) < self.batch_size:
+            timeout: float = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                event = await asyncio.wait_for(self.queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            batch[event.uid] = event
+        return batch
+
+    async def flush(self, batch: dict) -> None:
+        """Adds a batch of Events not already added."""
+        events = [event for uid, event in batch.items() if uid not in self.added]
+        if events:
+            self._logger.debug("Adding batch of %s", len(events))
+            await asyncio.gather(*(self.add(event) for event in events))
+
+    async def add(self, event: CoTEvent) -> None:
+        """Adds an Event, retrying with exponential backoff."""
+        for attempt in range(self.retries + 1):
+            try:
+                await self.create_co_and_tf(event)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+                self._logger.debug("%s add failed: %s", event.uid, exc)
+                if attempt < self.retries:
+                    await asyncio.sleep(self.RETRY_BACKOFF * 2**attempt)
+                continue
+
+            self.added[event.uid] = True
+            if len(self.added) > self.MAX_ADDED:
+                self.added.popitem(last=False)
+            return
+        self._logger.warning("%s not added after %s attempts", event.uid, attempt + 1)
+
+    async def create_co_and_tf(self, event: CoTEvent) -> None:
+        """
+        Creates a COTObject & Transform with the given Event, if neither CO or TF exist.
+        """
+        uid: str = event.uid
+        callsign: str = event.callsign
+        self._logger.info("%s added (AUTO_ADD=True)", uid)
+
+        # Create a COT Object
+        co_url: str = "/co/"
+        async with self.session.post(co_url, json={"uid": uid}) as resp:
+            self._logger.debug("%s call status: %s", co_url, resp.status)
+            if resp.status >= 500:
+                resp.raise_for_status()
+
+        if callsign:
+            # Populate the transform
+            tf_url: str = "/tf/"
+            tf_payload = {
+                "cot_uid": uid,
+                "cot_type": event.cot_type,
+                "callsign": callsign,
+            }
+            try:
+                remarks = event.element().find("detail/remarks")
+            except ET.ParseError as exc:
+                self._logger.warning("%s remarks not parsed: %s", uid, exc)
+                remarks = None
+            if remarks is not None:
+                tf_payload["remarks"] = remarks.text
+            else:
+                tf_payload["remarks"] = None
+
+            async with self.session.post(tf_url, json=tf_payload) as resp:
+                self._logger.debug("%s call status: %s", tf_url, resp.status)
+                if resp.status >= 500:
+                    resp.raise_for_status()
+
+
+class EgressSpool:
+
+    """
+    Append-only, segment-rotated on-disk spool of egress CoT Events.
+
+    Events are appended to the newest segment file, which is rotated once it
+    reaches `segment_bytes`. Reads memory-map the oldest closed segment and the
+    segment is deleted once drained, so delivery is at-least-once across
+    restarts. The oldest segments are dropped whenever the spool grows beyond
+    `max_bytes`, and Events older than `max_age` seconds are discarded.
+    """
+
+    _logger = logging.getLogger(__name__)
+
+    SUFFIX: str = ".spool"
+
+    def __init__(
+        self,
+        path: str,
+        max_bytes: int = cotproxy.DEFAULT_SPOOL_MAX_BYTES,
+        max_age: int = cotproxy.DEFAULT_SPOOL_MAX_AGE,
+        segment_bytes: int = cotproxy.DEFAULT_SPOOL_SEGMENT_BYTES,
+    ) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.segment_bytes = segment_bytes
+        self.dropped: int = 0
+
+        os.makedirs(path, exist_ok=True)
+        self.segments = collections.deque(
+            sorted(
+                os.path.join(path, name)
+                for name in os.listdir(path)
+                if name.endswith(self.SUFFIX)
+            )
+        )
+        self.size: int = sum(os.path.getsize(seg) for seg in self.segments)
+        self._seq: int = (
+            int(os.path.basename(self.segments[-1])[: -len(self.SUFFIX)]) + 1
+            if self.segments
+            else 0
+        )
+        self._writer = None
+        self._written: int = 0
+        self._reader = None
+        self._offset: int = 0
+
+    def __len__(self) -> int:
+        """Bytes held in the spool."""
+        return self.size
+
+    def append(self, data: bytes) -> None:
+        """Appends an Event to the spool."""
+        if self._writer is None or self._written >= self.segment_bytes:
+            self._rotate()
+        record: bytes = cotproxy.pack_record(time.time(), data)
+        self._writer.write(record)
+        self._written += len(record)
+        self.size += len(record)
+        self._enforce_max_bytes()
+
+    def pop(self) -> Union[bytes, None]:
+        """Returns the oldest spooled Event, or None if the spool is empty."""
+        while self.size:
+            if self._reader is None and not self._open_reader():
+                return None
+
+            records = cotproxy.unpack_records(self._reader, self._offset)
+            record = next(records, None)
+            if record is None:
+                self._remove_reader()
+                continue
+
+            timestamp, data, self._offset = record
+            if self.max_age and time.time() - timestamp > self.max_age:
+                self.dropped += 1
+                continue
+            return data
+        return None
+
+    def close(self) -> None:
+        """Flushes & closes the spool's segment files."""
+        self._close_writer()
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+
+    def _rotate(self) -> None:
+        self._close_writer()
+        segment: str = os.path.join(self.path, f"{self._seq:012d}{self.SUFFIX}")
+        self._seq += 1
+        self.segments.append(segment)
+        self._writer = open(segment, "ab")
+        self._written = 0
+
+    def _close_writer(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+            if not self._written:
+                self._remove(self.segments.pop())
+
+    def _open_reader(self) -> bool:
+        if self._writer is not None and len(self.segments) == 1:
+            self._close_writer()
+        if not self.segments:
+            return False
+
+        segment: str = self.segments[0]
+        if not os.path.getsize(segment):
+            self._remove(self.segments.popleft())
+            return self._open_reader()
+
+        with open(segment, "rb") as seg_fd:
+            self._reader = mmap.mmap(seg_fd.fileno(), 0, access=mmap.ACCESS_READ)
+        self._offset = 0
+        return True
+
+    def _remove_reader(self) -> None:
+        self._reader.close()
+        self._reader = None
+        self._remove(self.segments.popleft())
+
+    def _remove(self, segment: str) -> None:
+        self.size -= os.path.getsize(segment)
+        os.remove(segment)
+
+    def _enforce_max_bytes(self) -> None:
+        while self.size > self.max_bytes and len(self.segments) > 1:
+            if self._reader is not None:
+                self._reader.close()
+                self._reader = None
+            self._logger.warning(
+                "Spool over %s bytes, dropping %s", self.max_bytes, self.segments[0]
+            )
+            self._remove(self.segments.popleft())
+
+
+class SpoolWorker(pytak.Worker):
+
+    """
+    Moves egress CoT Events onto the TX Queue, spooling them to disk while the
+    TX Queue is full (e.g. the destination is stalled) and draining the spool at
+    no more than SPOOL_DRAIN_RATE Events per second once it has room again.
+
+    When the connection to the destination fails, PyTAK stops every Worker
+    until it reconnects, so Events still queued are spooled as this Worker
+    stops and are sent once reconnected (or restarted).
+    """
+
+    def __init__(self, queue: asyncio.Queue, config, tx_queue: asyncio.Queue) -> None:
+        super().__init__(queue, config)
+        self.tx_queue = tx_queue
+        self.drain_rate: int = int(
+            self.config.get("SPOOL_DRAIN_RATE", cotproxy.DEFAULT_SPOOL_DRAIN_RATE)
+        )
+        self.spool = EgressSpool(
+            self.config.get("SPOOL_DIR", cotproxy.DEFAULT_SPOOL_DIR),
+            int(self.config.get("SPOOL_MAX_BYTES", cotproxy.DEFAULT_SPOOL_MAX_BYTES)),
+            int(self.config.get("SPOOL_MAX_AGE", cotproxy.DEFAULT_SPOOL_MAX_AGE)),
+            int(
+                self.config.get(
+                    "SPOOL_SEGMENT_BYTES", cotproxy.DEFAULT_SPOOL_SEGMENT_BYTES
+                )
+            ),
+        )
+
+    async def handle_data(self, data: bytes) -> None:
+        """Passes an Event to the TX Queue, or the spool if it's backed up."""
+        # Once spooling, keep spooling until drained so Events stay in order.
+        if len(self.spool) or self.tx_queue.full():
+            self.spool.append(data)
+        else:
+            self.tx_queue.put_nowait(data)
+
+    async def drain(self, interval: float = 0.1) -> None:
+        """Drains the spool onto the TX Queue at SPOOL_DRAIN_RATE."""
+        budget: int = max(1, int(self.drain_rate * interval))
+        while 1:
+            for _ in range(budget):
+                if self.tx_queue.full():
+                    break
+                data = self.spool.pop()
+                if data is None:
+                    break
+                self.tx_queue.put_nowait(data)
+            await asyncio.sleep(interval)
+
+    async def run(self, number_of_iterations=-1) -> None:
+        """Runs this Thread."""
+        self._logger.info("%s spooling to: %s", self.__class__, self.spool.path)
+        drain = asyncio.ensure_future(self.drain())
+        try:
+            while 1:
+                await self.handle_data(await self.queue.get())
+        finally:
+            drain.cancel()
+            self.spool_pending()
+            self.spool.close()
+
+    def spool_pending(self) -> None:
+        """
+        Spools the Events still queued, which would otherwise be discarded.
+
+        Events on the TX Queue were queued before any in the spool, but are
+        spooled after them.
+        """
+        for queue in (self.tx_queue, self.queue):
+            while not queue.empty():
+                self.spool.append(queue.get_nowait())
+
+
+class FanoutWorker(pytak.Worker):
+
+    """
+    Copies every outgoing CoT Event to each destination's TX Queue.
+
+    Destinations are the config sections PyTAK creates TX workers for with
+    IMPORT_OTHER_CONFIGS, each with its own COT_URL & TAK_PROTO, so one
+    destination can be sent TAK Protocol while another is sent XML. The first
+    destination applies backpressure, the others drop Events while their TX
+    Queue is full so a slow destination can't hold up the rest.
+    """
+
+    def __init__(self, queue: asyncio.Queue, config, destinations: list) -> None:
+        super().__init__(queue, config)
+        self.destinations = destinations
+        self.dropped: int = 0
+
+    async def handle_data(self, data) -> None:
+        """Puts data on every destination's TX Queue."""
+        primary, *others = self.destinations
+        for destination in others:
+            try:
+                destination.put_nowait(data)
+            except asyncio.QueueFull:
+                self.dropped += 1
+        await primary.put(data)
+
+    async def run(self, number_of_iterations=-1) -> None:
+        """Runs this Thread."""
+        self._logger.info("Sending to %s destinations", len(self.destinations))
+        while 1:
+            await self.handle_data(await self.queue.get())
+
+
+class CoalescingTXWorker(pytak.TXWorker):
+
+    """
+    Sends CoT Events to a TCP destination a batch at a time.
+
+    Everything already waiting on the TX Queue, up to EGRESS_MAX_COUNT Events
+    or EGRESS_MAX_BYTES bytes, is sent with a single `writelines()` & drain
+    instead of a write & drain per Event. With EGRESS_LINGER set, a batch waits
+    up to that many seconds for more Events, trading latency for fewer writes.
+    """
+
+    def __init__(self, queue: asyncio.Queue, config, writer) -> None:
+        super().__init__(queue, config, writer)
+        self.max_bytes: int = int(
+            self.config.get("EGRESS_MAX_BYTES", cotproxy.DEFAULT_EGRESS_MAX_BYTES)
+        )
+        self.max_count: int = int(
+            self.config.get("EGRESS_MAX_COUNT", cotproxy.DEFAULT_EGRESS_MAX_COUNT)
+        )
+        self.linger: float = float(
+            self.config.get("EGRESS_LINGER", cotproxy.DEFAULT_EGRESS_LINGER)
+        )
+        self.writes: int = 0
+        self.events: int = 0
+
+    async def collect(self) -> list:
+        """Gets the next batch of Events from the TX Queue."""
+        batch: list = [await self.queue.get()]
+        size: int = len(batch[0] or b"")
+        loop = asyncio.get_running_loop()
+        deadline: float = loop.time() + self.linger
+        while len(batch) < self.max_count and size < self.max_bytes:
+            if not self.queue.empty():
+                data = self.queue.get_nowait()
+            else:
+                remaining: float = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    data = await asyncio.wait_for(self.queue.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+            batch.append(data)
+            size += len(data or b"")
+        return batch
+
+    def encode(self, data: bytes) -> Union[bytes, None]:
+        """Encodes an Event as TAK Protocol Stream if TAK_PROTO is set."""
+        if not self.use_protobuf:
+            return data
+        try:
+            return bytes(takproto.xml2proto(data, takproto.TAKProtoVer.STREAM))
+        except ET.ParseError as exc:
+            self._logger.warning("Not sending unparseable CoT: %s", exc)
+            return None
+
+    async def send_batch(self, batch: list) -> None:
+        """Sends a batch of Events with a single write & drain."""
+        chunks: list = [
+            chunk for chunk in map(self.encode, filter(None, batch)) if chunk
+        ]
+        if not chunks:
+            return
+        self.writer.writelines(chunks)
+        await self.writer.drain()
+        self.writes += 1
+        self.events += len(chunks)
+
+    async def run_once(self) -> None:
+        """Sends the next batch of Events from the TX Queue."""
+        await self.send_batch(await self.collect())
+        await self.fts_compat()
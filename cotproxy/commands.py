@@ -18,7 +18,13 @@
 
 """PyTAK Command Line."""
 
+import argparse
+import asyncio
+import logging
+import os
+
 import pytak
+import cotproxy
 
 __author__ = "Greg Albrecht W2GMD <oss@undef.net>"
 __copyright__ = "Copyright 2022 Greg Albrecht"
@@ -27,9 +33,58 @@ __license__ = "Apache License, Version 2.0"
 
 def main() -> None:
     """Main function."""
+    # Remember the config file, so COTProxyWorker can re-read it on SIGHUP:
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("-c", "--CONFIG_FILE", dest="CONFIG_FILE", default="config.ini")
+    namespace, _ = parser.parse_known_args()
+    os.environ.setdefault("CONFIG_FILE", os.path.abspath(namespace.CONFIG_FILE))
+
+    # Install the configured event loop before PyTAK starts one:
+    config = cotproxy.load_config(os.environ["CONFIG_FILE"])
+    event_loop: str = config.get("EVENT_LOOP", cotproxy.DEFAULT_EVENT_LOOP)
+    policy = cotproxy.event_loop_policy(event_loop)
+    if event_loop.strip().lower() == "uvloop" and not cotproxy.functions.with_uvloop:
+        logging.warning(
+            "uvloop not installed, using asyncio event loop. Install with: "
+            "python3 -m pip install cotproxy[with_uvloop]"
+        )
+    asyncio.set_event_loop_policy(policy)
+
     # PyTAK CLI tool boilerplate:
     pytak.cli(__name__.split(".", maxsplit=1)[0])
 
 
+def replay() -> None:
+    """Replays a traffic capture into a COTProxy listener & reports throughput."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("CAPTURE_FILE", type=str, help="Capture file to replay.")
+    parser.add_argument(
+        "-u",
+        "--URL",
+        dest="URL",
+        default=cotproxy.DEFAULT_REPLAY_URL,
+        type=str,
+        help=f"Listener URL to replay into. Default: {cotproxy.DEFAULT_REPLAY_URL}",
+    )
+    parser.add_argument(
+        "-s",
+        "--SPEED",
+        dest="SPEED",
+        default=1.0,
+        type=float,
+        help="Replay speed multiplier, 0 replays as fast as possible. Default: 1",
+    )
+    namespace = parser.parse_args()
+
+    events, size, elapsed = asyncio.run(
+        cotproxy.replay_capture(namespace.CAPTURE_FILE, namespace.URL, namespace.SPEED)
+    )
+    elapsed = elapsed or 1e-9
+    print(
+        f"Replayed {events} events ({size} bytes) in {elapsed:.3f}s: "
+        f"{events / elapsed:.1f} events/s, {size / elapsed / 1024:.1f} KiB/s"
+    )
+
+
 if __name__ == "__main__":
     main()
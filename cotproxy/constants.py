@@ -48,3 +48,77 @@ DEFAULT_CPAPI_URL: str = "http://localhost:10415/"
 DEFAULT_LISTEN_URL: str = "udp://0.0.0.0:8087"
 DEFAULT_KNOWN_CRAFT_FILE: str = "known_craft.csv"
 DEFAULT_SEED_FAA_REG: bool = True
+DEFAULT_DROP_STALE: bool = True
+# Event loop implementation, 'asyncio' or 'uvloop' (if installed):
+DEFAULT_EVENT_LOOP: str = "asyncio"
+# COTProxyWeb API client tuning, see ``TransformLookup``:
+DEFAULT_CPAPI_POOL_SIZE: int = 20
+DEFAULT_CPAPI_KEEPALIVE: float = 30.0
+DEFAULT_CPAPI_TIMEOUT: float = 5.0
+DEFAULT_CPAPI_BATCH_PATH: str = "/tf/batch/"
+DEFAULT_LOOKUP_WINDOW: float = 0.005
+DEFAULT_LOOKUP_BATCH: int = 100
+DEFAULT_TF_CACHE_TTL: float = 60.0
+DEFAULT_TF_CACHE_SIZE: int = 100000
+# Transform change stream (Server-Sent Events), see ``TransformSubscription``:
+DEFAULT_CPAPI_EVENTS_PATH: str = "/tf/events/"
+DEFAULT_SUBSCRIBE_TIMEOUT: float = 90.0
+
+# Transform & icon cache snapshot for warm restarts, disabled unless CACHE_FILE is set.
+DEFAULT_CACHE_FILE: str = ""
+DEFAULT_CACHE_SAVE_INTERVAL: int = 300
+
+DEFAULT_AUTO_ADD_WINDOW: float = 1.0
+DEFAULT_AUTO_ADD_BATCH: int = 100
+DEFAULT_AUTO_ADD_RETRIES: int = 3
+DEFAULT_MAX_AUTO_ADD_QUEUE: int = 10000
+DEFAULT_STATS_INTERVAL: int = 60
+
+# Ingest priority classes as comma separated CoT type prefix:priority pairs,
+# lower numbers are served first. Unmatched types get the lowest priority.
+DEFAULT_PRIORITY_CLASSES: str = "b-a-o-:0,b-r-f-h-c:0,a-f-G:1"
+DEFAULT_PRIORITY_MAX_WAIT: float = 1.0
+DEFAULT_MAX_TF_QUEUE: int = 0
+
+# Load shedding on tf_queue sojourn time, disabled unless SHED_TARGET is set.
+DEFAULT_SHED_TARGET: float = 0.0
+DEFAULT_SHED_HOLD: float = 2.0
+
+# Movement-based track thinning, disabled unless THIN_INTERVAL is set.
+DEFAULT_THIN_INTERVAL: int = 0
+DEFAULT_THIN_DISTANCE: float = 50.0
+DEFAULT_THIN_COURSE: float = 15.0
+DEFAULT_THIN_ALTITUDE: float = 30.0
+DEFAULT_THIN_MAX_TRACKS: int = 100000
+
+# GeoJSON geofences, disabled unless GEOFENCE_FILE is set.
+DEFAULT_GEOFENCE_FILE: str = ""
+DEFAULT_GEOFENCE_CELL_SIZE: float = 1.0
+
+# Traffic capture of received CoT, gzip compressed if the file ends in '.gz'.
+DEFAULT_CAPTURE_FILE: str = ""
+DEFAULT_REPLAY_URL: str = "udp://127.0.0.1:8087"
+
+# Disk-backed egress spool, see ``SpoolWorker``. Disabled unless SPOOL_DIR is set.
+DEFAULT_SPOOL_DIR: str = ""
+DEFAULT_SPOOL_MAX_BYTES: int = 104857600
+DEFAULT_SPOOL_MAX_AGE: int = 3600
+DEFAULT_SPOOL_SEGMENT_BYTES: int = 4194304
+DEFAULT_SPOOL_DRAIN_RATE: int = 500
+
+# Coalesced egress writes to TCP destinations, see ``CoalescingTXWorker``:
+DEFAULT_EGRESS_COALESCE: bool = False
+DEFAULT_EGRESS_MAX_BYTES: int = 65536
+DEFAULT_EGRESS_MAX_COUNT: int = 256
+DEFAULT_EGRESS_LINGER: float = 0.0
+
+# Worker pool for parsing & serializing CoT, 'thread' or 'process'. Disabled
+# unless POOL is set, POOL_WORKERS=0 uses one worker per CPU.
+DEFAULT_POOL: str = ""
+DEFAULT_POOL_WORKERS: int = 0
+DEFAULT_POOL_BATCH: int = 64
+
+# TCP listener limits, see ``NetWorker.start_tcp_listener()``:
+DEFAULT_MAX_CONNECTIONS: int = 256
+DEFAULT_MAX_BUFFER: int = 65536
+DEFAULT_IDLE_TIMEOUT: int = 300
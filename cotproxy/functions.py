@@ -19,15 +19,43 @@
 """COTProxy Functions."""
 
 import asyncio
+import calendar
+import concurrent.futures
+import datetime
+import gzip
+import json
+import math
+import os
 import platform
+import re
+import struct
+import zlib
 import xml.etree.ElementTree as ET
 
-from configparser import SectionProxy
-from typing import Set
+from configparser import ConfigParser, SectionProxy
+from xml.sax.saxutils import unescape
+from typing import Callable, Iterator, Set, Tuple, Union
 
+import aiohttp
 import pytak
 import cotproxy
 
+with_uvloop: bool = False
+try:
+    import uvloop
+
+    with_uvloop = True
+except ImportError:
+    pass
+
+with_takproto: bool = False
+try:
+    from takproto.proto import TakMessage
+
+    with_takproto = True
+except ImportError:
+    pass
+
 
 __author__ = "Greg Albrecht W2GMD <oss@undef.net>"
 __copyright__ = "Copyright 2022 Greg Albrecht"
@@ -52,10 +80,574 @@ def create_tasks(
     `set`
         Set of PyTAK Worker classes for this application.
     """
-    tf_queue: asyncio.Queue = asyncio.Queue()
-    net_worker = cotproxy.NetWorker(tf_queue, config)
-    tf_worker = cotproxy.COTProxyWorker(clitool.tx_queue, config, tf_queue)
-    return set([net_worker, tf_worker])
+    tasks: set = set()
+    tx_queue: asyncio.Queue = clitool.tx_queue
+
+    if config.get("SPOOL_DIR", cotproxy.DEFAULT_SPOOL_DIR):
+        egress_queue: asyncio.Queue = asyncio.Queue(clitool.tx_queue.maxsize)
+        tasks.add(cotproxy.SpoolWorker(egress_queue, config, clitool.tx_queue))
+        tx_queue = egress_queue
+
+    # Other config sections imported by PyTAK are additional destinations:
+    destinations: list = [tx_queue] + [
+        queues["tx_queue"]
+        for queues in getattr(clitool, "queues", {}).values()
+        if queues["tx_queue"] is not clitool.tx_queue
+    ]
+    if len(destinations) > 1:
+        fanout_queue: asyncio.Queue = asyncio.Queue(clitool.tx_queue.maxsize)
+        tasks.add(cotproxy.FanoutWorker(fanout_queue, config, destinations))
+        tx_queue = fanout_queue
+
+    tf_queue: asyncio.Queue = cotproxy.TypePriorityQueue(
+        int(config.get("MAX_TF_QUEUE", cotproxy.DEFAULT_MAX_TF_QUEUE)),
+        parse_priority_classes(
+            config.get("PRIORITY_CLASSES", cotproxy.DEFAULT_PRIORITY_CLASSES)
+        ),
+        float(config.get("PRIORITY_MAX_WAIT", cotproxy.DEFAULT_PRIORITY_MAX_WAIT)),
+    )
+    auto_add_queue: asyncio.Queue = asyncio.Queue(
+        int(config.get("MAX_AUTO_ADD_QUEUE", cotproxy.DEFAULT_MAX_AUTO_ADD_QUEUE))
+    )
+    pool = worker_pool(config)
+    tasks.add(cotproxy.NetWorker(tf_queue, config, pool))
+    tasks.add(
+        cotproxy.COTProxyWorker(tx_queue, config, tf_queue, auto_add_queue, pool)
+    )
+    tasks.add(cotproxy.AutoAddWorker(auto_add_queue, config))
+
+    if config.getboolean("EGRESS_COALESCE", cotproxy.DEFAULT_EGRESS_COALESCE):
+        coalesce_tx_workers(clitool)
+    return tasks
+
+
+def coalesce_tx_workers(clitool: pytak.CLITool) -> None:
+    """
+    Swaps the CLITool's TCP & TLS `pytak.TXWorker`s for `CoalescingTXWorker`s.
+
+    UDP, log & file destinations keep sending one Event at a time.
+    """
+    for worker in list(clitool.tasks):
+        if type(worker) is not pytak.TXWorker:
+            continue
+        if not isinstance(worker.writer, asyncio.StreamWriter):
+            continue
+        clitool.tasks.discard(worker)
+        clitool.add_task(
+            cotproxy.CoalescingTXWorker(worker.queue, worker.config, worker.writer)
+        )
+
+
+# Worker pools by kind & size, kept across reconnects of `create_tasks()`:
+POOLS: dict = {}
+
+
+def worker_pool(config: SectionProxy) -> Union[concurrent.futures.Executor, None]:
+    """
+    Returns the POOL worker pool for parsing & serializing CoT, None if disabled.
+
+    A 'process' pool parses on spare cores, a 'thread' pool only moves the
+    work off the event loop as parsing holds the GIL.
+    """
+    kind: str = config.get("POOL", cotproxy.DEFAULT_POOL).strip().lower()
+    if not kind:
+        return None
+    workers: int = int(config.get("POOL_WORKERS", cotproxy.DEFAULT_POOL_WORKERS))
+    workers = workers or os.cpu_count() or 1
+
+    pool = POOLS.get((kind, workers))
+    if pool is None:
+        if kind == "process":
+            pool = concurrent.futures.ProcessPoolExecutor(workers)
+        elif kind == "thread":
+            pool = concurrent.futures.ThreadPoolExecutor(workers, "cotproxy")
+        else:
+            raise ValueError(f"Unknown POOL '{kind}', use 'thread' or 'process'")
+        POOLS[(kind, workers)] = pool
+    return pool
+
+
+def map_batch(func: Callable, items: list) -> list:
+    """
+    Applies `func` to each item of a batch, in a worker pool.
+
+    Returns
+    -------
+    `list`
+        For each item, a tuple of True & the result, or False & the exception.
+    """
+    results: list = []
+    for item in items:
+        try:
+            results.append((True, func(item)))
+        except Exception as exc:  # pylint: disable=broad-except
+            results.append((False, exc))
+    return results
+
+
+def render_transform(job: Tuple[bytes, dict]) -> bytes:
+    """Transforms the raw bytes of a CoT Event, returning the transformed bytes."""
+    raw, transform = job
+    return ET.tostring(transform_cot(parse_cot(raw), transform))
+
+
+# Record framing shared by the egress spool & traffic captures:
+# timestamp (double), payload length (uint32), payload.
+RECORD_HEADER = struct.Struct("<dI")
+
+
+def pack_record(timestamp: float, data: bytes) -> bytes:
+    """Frames `data` with its timestamp for an on-disk spool or capture."""
+    return RECORD_HEADER.pack(timestamp, len(data)) + data
+
+
+def unpack_records(buf, offset: int = 0) -> Iterator[Tuple[float, bytes, int]]:
+    """
+    Iterates over framed records in `buf` (bytes, mmap, etc.) from `offset`.
+
+    Yields
+    ------
+    `tuple`
+        The record's timestamp, payload and the offset of the following record.
+        A truncated trailing record is ignored.
+    """
+    end: int = len(buf)
+    while offset + RECORD_HEADER.size <= end:
+        timestamp, length = RECORD_HEADER.unpack_from(buf, offset)
+        start: int = offset + RECORD_HEADER.size
+        if start + length > end:
+            return
+        offset = start + length
+        yield timestamp, buf[start:offset], offset
+
+
+def load_config(config_file: str, section: str = "cotproxy") -> SectionProxy:
+    """
+    Reads the config file over the environment, the same way `pytak.cli()` does.
+
+    Parameters
+    ----------
+    config_file : `str`
+        Path to the INI-style config file, environment only if it doesn't exist.
+    section : `str`
+        Config section to return.
+
+    Returns
+    -------
+    `configparser.SectionProxy`
+        Configuration options & values.
+    """
+    env_vars: dict = {key: val for key, val in os.environ.items() if "%" not in val}
+    config: ConfigParser = ConfigParser(env_vars)
+    if os.path.exists(config_file):
+        config.read(config_file)
+    if not config.has_section(section):
+        config.add_section(section)
+    return config[section]
+
+
+def event_loop_policy(name: str) -> asyncio.AbstractEventLoopPolicy:
+    """
+    Returns the event loop policy for the named loop implementation.
+
+    Parameters
+    ----------
+    name : `str`
+        'uvloop' for uvloop, falling back to asyncio's default loop if uvloop
+        isn't installed. Any other name is asyncio's default loop.
+
+    Returns
+    -------
+    `asyncio.AbstractEventLoopPolicy`
+        Policy whose `new_event_loop()` creates loops of that implementation.
+    """
+    if name.strip().lower() == "uvloop" and with_uvloop:
+        return uvloop.EventLoopPolicy()
+    return asyncio.DefaultEventLoopPolicy()
+
+
+def cpapi_session(config: SectionProxy) -> aiohttp.ClientSession:
+    """
+    Creates a COTProxyWeb API client session with a tuned connection pool.
+
+    The pool size (CPAPI_POOL_SIZE), keep-alive (CPAPI_KEEPALIVE) and
+    per-request timeout (CPAPI_TIMEOUT) come from the config.
+    """
+    connector = aiohttp.TCPConnector(
+        limit=int(config.get("CPAPI_POOL_SIZE", cotproxy.DEFAULT_CPAPI_POOL_SIZE)),
+        keepalive_timeout=float(
+            config.get("CPAPI_KEEPALIVE", cotproxy.DEFAULT_CPAPI_KEEPALIVE)
+        ),
+    )
+    timeout = aiohttp.ClientTimeout(
+        total=float(config.get("CPAPI_TIMEOUT", cotproxy.DEFAULT_CPAPI_TIMEOUT))
+    )
+    return aiohttp.ClientSession(
+        config.get("CPAPI_URL", cotproxy.DEFAULT_CPAPI_URL),
+        connector=connector,
+        timeout=timeout,
+    )
+
+
+# Cache snapshot framing: magic, format version, CRC32 & length of the body,
+# followed by the zlib compressed JSON body.
+CACHE_MAGIC: bytes = b"CPXC"
+CACHE_VERSION: int = 1
+CACHE_HEADER = struct.Struct("<4sHII")
+
+
+def save_cache_snapshot(path: str, snapshot: dict) -> int:
+    """
+    Atomically writes a cache snapshot to `path`.
+
+    Returns
+    -------
+    `int`
+        Size of the written snapshot in bytes.
+    """
+    body: bytes = zlib.compress(
+        json.dumps(snapshot, separators=(",", ":")).encode(), 1
+    )
+    header: bytes = CACHE_HEADER.pack(
+        CACHE_MAGIC, CACHE_VERSION, zlib.crc32(body), len(body)
+    )
+    tmp_path: str = f"{path}.tmp"
+    with open(tmp_path, "wb") as snapshot_fd:
+        snapshot_fd.write(header + body)
+    os.replace(tmp_path, path)
+    return len(header) + len(body)
+
+
+def load_cache_snapshot(path: str) -> dict:
+    """
+    Reads a cache snapshot written by `save_cache_snapshot()`.
+
+    Raises
+    ------
+    `ValueError`
+        If the snapshot is truncated, corrupt or of another format version.
+    """
+    with open(path, "rb") as snapshot_fd:
+        data: bytes = snapshot_fd.read()
+
+    if len(data) < CACHE_HEADER.size:
+        raise ValueError("Truncated cache snapshot")
+    magic, version, crc, length = CACHE_HEADER.unpack_from(data)
+    if magic != CACHE_MAGIC:
+        raise ValueError("Not a cache snapshot")
+    if version != CACHE_VERSION:
+        raise ValueError(f"Unsupported cache snapshot version: {version}")
+    body: bytes = data[CACHE_HEADER.size :]
+    if len(body) != length or zlib.crc32(body) != crc:
+        raise ValueError("Cache snapshot checksum mismatch")
+    return json.loads(zlib.decompress(body))
+
+
+def read_capture(path: str) -> Iterator[Tuple[float, bytes]]:
+    """
+    Iterates over the records of a capture file written by `CaptureWriter`.
+
+    A capture that wasn't closed cleanly is read up to where it was truncated.
+
+    Yields
+    ------
+    `tuple`
+        Each record's receive timestamp and raw received data.
+    """
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as capture_fd:
+        while 1:
+            try:
+                header: bytes = capture_fd.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    return
+                timestamp, length = RECORD_HEADER.unpack(header)
+                data: bytes = capture_fd.read(length)
+            except (EOFError, zlib.error):
+                # A compressed capture without its end-of-stream marker:
+                return
+            if len(data) < length:
+                return
+            yield timestamp, data
+
+
+async def replay_capture(
+    path: str, url: str = cotproxy.DEFAULT_REPLAY_URL, speed: float = 1.0
+) -> Tuple[int, int, float]:
+    """
+    Replays a capture file into a UDP or TCP listener.
+
+    Parameters
+    ----------
+    path : `str`
+        Capture file written by `CaptureWriter`.
+    url : `str`
+        Listener to replay into, e.g. 'udp://127.0.0.1:8087'.
+    speed : `float`
+        Replay speed relative to the original receive times, 0 is as fast as
+        possible.
+
+    Returns
+    -------
+    `tuple`
+        Events replayed, bytes replayed & elapsed seconds.
+    """
+    loop = asyncio.get_running_loop()
+    host, port = pytak.parse_url(url)
+    writer = None
+    transport = None
+    if url.lower().startswith("tcp"):
+        _, writer = await asyncio.open_connection(host, port)
+    else:
+        transport, _ = await loop.create_datagram_endpoint(
+            asyncio.DatagramProtocol, remote_addr=(host, port)
+        )
+
+    events: int = 0
+    size: int = 0
+    first = None
+    start: float = loop.time()
+    for timestamp, data in read_capture(path):
+        if speed > 0:
+            first = first if first is not None else timestamp
+            delay: float = (timestamp - first) / speed - (loop.time() - start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+        if writer:
+            writer.write(data)
+            await writer.drain()
+        else:
+            transport.sendto(data)
+            if events % 64 == 0:
+                await asyncio.sleep(0)
+        events += 1
+        size += len(data)
+
+    if writer:
+        writer.close()
+        await writer.wait_closed()
+    else:
+        transport.close()
+    return events, size, loop.time() - start
+
+
+def parse_priority_classes(value: str) -> dict:
+    """
+    Parses a PRIORITY_CLASSES config value into a dict of CoT type prefixes.
+
+    Parameters
+    ----------
+    value : `str`
+        Comma separated `prefix:priority` pairs, e.g. 'b-a-o-:0,a-f-G:1'.
+
+    Returns
+    -------
+    `dict`
+        CoT type prefix to integer priority, lower is served first.
+    """
+    classes: dict = {}
+    for pair in value.split(","):
+        if not pair.strip():
+            continue
+        prefix, _, priority = pair.rpartition(":")
+        classes[prefix.strip()] = int(priority)
+    return classes
+
+
+# Cheap, tree-less extraction of the fields COTProxy uses from raw CoT:
+EVENT_RE = re.compile(rb"<event\b[^>]*?(?:/>|>.*?</event>)", re.DOTALL)
+EVENT_TAG_RE = re.compile(rb"<event\b[^>]*>")
+POINT_TAG_RE = re.compile(rb"<point\b[^>]*>")
+TRACK_TAG_RE = re.compile(rb"<track\b[^>]*>")
+ATTRIB_RE = re.compile(rb"""([\w:-]+)\s*=\s*(["'])(.*?)\2""", re.DOTALL)
+CALLSIGN_RE = re.compile(rb"""\scallsign\s*=\s*(["'])(.*?)\1""", re.DOTALL)
+XML_ENTITIES: dict = {"&quot;": '"', "&apos;": "'"}
+
+
+def split_events(data: bytes) -> list:
+    """Splits received data into the raw bytes of each CoT Event within."""
+    return EVENT_RE.findall(data)
+
+
+def tag_attrib(tag: bytes) -> dict:
+    """Returns the attributes of a raw XML start tag as a dict of `str`."""
+    return {
+        key.decode(): unescape(val.decode(), XML_ENTITIES)
+        for key, _, val in ATTRIB_RE.findall(tag)
+    }
+
+
+def parse_events(data: bytes) -> list:
+    """
+    Parses received data into a list of `cotproxy.CoTEvent`.
+
+    Data may be CoT XML or TAK Protocol Version 1 (protobuf), which is decoded
+    to CoT XML so it is transformed & passed on the same way.
+    """
+    if data[:1] == TAK_MAGIC:
+        return parse_proto_events(data)
+    return [cotproxy.CoTEvent.from_bytes(raw) for raw in split_events(data)]
+
+
+# TAK Protocol Version 1: Mesh messages are prefixed with this header, Stream
+# messages with the magic byte and a varint length.
+TAK_MAGIC: bytes = b"\xbf"
+TAK_MESH_HEADER: bytes = b"\xbf\x01\xbf"
+
+
+def read_varint(data: bytes, offset: int = 0) -> Tuple[int, int]:
+    """
+    Reads a protobuf varint from `data` at `offset`.
+
+    Returns
+    -------
+    `tuple`
+        The varint's value and the offset following it.
+
+    Raises
+    ------
+    `ValueError`
+        If the varint is truncated or longer than 64 bits.
+    """
+    value: int = 0
+    for shift in range(0, 64, 7):
+        if offset >= len(data):
+            raise ValueError("Truncated varint")
+        byte: int = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, offset
+    raise ValueError("Varint too long")
+
+
+def split_proto(data: bytes) -> list:
+    """Splits TAK Protocol Mesh or Stream data into its protobuf payloads."""
+    if data.startswith(TAK_MESH_HEADER):
+        return [data[len(TAK_MESH_HEADER) :]]
+
+    payloads: list = []
+    offset: int = 0
+    while offset < len(data):
+        if data[offset : offset + 1] != TAK_MAGIC:
+            raise ValueError("Not a TAK Protocol Stream message")
+        length, offset = read_varint(data, offset + 1)
+        if offset + length > len(data):
+            raise ValueError("Truncated TAK Protocol Stream message")
+        payloads.append(data[offset : offset + length])
+        offset += length
+    return payloads
+
+
+def parse_proto_events(data: bytes) -> list:
+    """Parses TAK Protocol Mesh or Stream data into a list of `cotproxy.CoTEvent`."""
+    if not with_takproto:
+        raise ValueError(
+            "Received TAK Protocol, but takproto is not installed. Install with: "
+            "python3 -m pip install cotproxy[with_takproto]"
+        )
+    events: list = []
+    for payload in split_proto(data):
+        message = TakMessage()
+        message.ParseFromString(payload)
+        # Skip TAK Control messages without a CoT Event:
+        if message.cotEvent.uid:
+            events.append(cotproxy.CoTEvent.from_bytes(takmsg_to_xml(message)))
+    return events
+
+
+def _ms_to_cot_time(millis: int) -> str:
+    timestamp = datetime.datetime.fromtimestamp(millis / 1000, datetime.timezone.utc)
+    return timestamp.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+
+
+def takmsg_to_xml(message) -> bytes:
+    """
+    Converts a TAK Protocol `TakMessage` to CoT XML, the reverse of
+    `takproto.xml2proto()`.
+    """
+    cot = message.cotEvent
+    event = ET.Element("event", version="2.0")
+    for attrib in ("type", "access", "qos", "opex", "uid", "how"):
+        val = getattr(cot, attrib)
+        if val:
+            event.set(attrib, val)
+    event.set("time", _ms_to_cot_time(cot.sendTime))
+    event.set("start", _ms_to_cot_time(cot.startTime))
+    event.set("stale", _ms_to_cot_time(cot.staleTime))
+    point_attribs: tuple = ("lat", "lon", "hae", "ce", "le")
+    ET.SubElement(
+        event, "point", {attrib: str(getattr(cot, attrib)) for attrib in point_attribs}
+    )
+
+    detail = ET.SubElement(event, "detail")
+    pb_detail = cot.detail
+    if pb_detail.xmlDetail:
+        detail.extend(ET.fromstring(f"<detail>{pb_detail.xmlDetail}</detail>"))
+
+    fields: tuple = (
+        ("contact", "contact", ("endpoint", "callsign")),
+        ("group", "__group", ("name", "role")),
+        ("precisionLocation", "precisionlocation", ("geopointsrc", "altsrc")),
+        ("takv", "takv", ("device", "platform", "os", "version")),
+        ("track", "track", ("speed", "course")),
+    )
+    for field, tag, attribs in fields:
+        if pb_detail.HasField(field):
+            value = getattr(pb_detail, field)
+            ET.SubElement(
+                detail,
+                tag,
+                {
+                    attrib: str(getattr(value, attrib))
+                    for attrib in attribs
+                    if getattr(value, attrib) or field == "track"
+                },
+            )
+    if pb_detail.HasField("status") and pb_detail.status.battery:
+        ET.SubElement(detail, "status", battery=str(pb_detail.status.battery))
+    return ET.tostring(event)
+
+
+def distance(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Returns the great-circle (haversine) distance between two points in meters."""
+    phi1: float = math.radians(lat1)
+    phi2: float = math.radians(lat2)
+    hav: float = (
+        math.sin((phi2 - phi1) / 2) ** 2
+        + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2
+    )
+    return 2 * 6371008.8 * math.asin(math.sqrt(min(1.0, hav)))
+
+
+def point_in_polygon(lon: float, lat: float, rings: list) -> bool:
+    """
+    Determines if a point is inside a GeoJSON Polygon (exterior ring & holes).
+
+    Parameters
+    ----------
+    lon : `float`
+        Longitude of the point.
+    lat : `float`
+        Latitude of the point.
+    rings : `list`
+        GeoJSON Polygon coordinates, the exterior ring followed by any holes,
+        each a list of [lon, lat] positions.
+    """
+    for index, ring in enumerate(rings):
+        crossings: bool = False
+        prev_lon, prev_lat = ring[-1][0], ring[-1][1]
+        for ring_lon, ring_lat, *_ in ring:
+            if (ring_lat > lat) != (prev_lat > lat):
+                slope: float = (prev_lon - ring_lon) / (prev_lat - ring_lat)
+                if lon < ring_lon + (lat - ring_lat) * slope:
+                    crossings = not crossings
+            prev_lon, prev_lat = ring_lon, ring_lat
+        # Must be inside the exterior ring (0) and outside of any holes:
+        if crossings != (index == 0):
+            return False
+    return bool(rings)
 
 
 def parse_cot(msg: str) -> ET.Element:
@@ -68,6 +660,41 @@ def parse_cot_multi(msg: str) -> ET.Element:
     return root
 
 
+def cot_time_to_epoch(value: Union[str, None]) -> Union[float, None]:
+    """
+    Converts a CoT timestamp (e.g. '2022-03-29T19:39:27.442994Z') to epoch seconds.
+
+    Cheaper than `datetime.strptime()` and tolerant of any number of fractional
+    digits. Returns None if the timestamp can't be parsed.
+    """
+    if not value or len(value) < 19:
+        return None
+    try:
+        epoch: float = calendar.timegm(
+            (
+                int(value[0:4]),
+                int(value[5:7]),
+                int(value[8:10]),
+                int(value[11:13]),
+                int(value[14:16]),
+                int(value[17:19]),
+                0,
+                0,
+                0,
+            )
+        )
+    except ValueError:
+        return None
+
+    if value[19:20] == ".":
+        end: int = 20
+        while end < len(value) and value[end].isdigit():
+            end += 1
+        if end > 20:
+            epoch += float(value[19:end])
+    return epoch
+
+
 def get_callsign(msg) -> str:
     return msg.find("detail").attrib.get(
         "callsign", msg.find("detail").find("contact").attrib.get("callsign")
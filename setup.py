@@ -67,6 +67,7 @@ setuptools.setup(
         "console_scripts": [
             f"{__title__} = {__title__}.commands:main",
             f"{__title__}-seed = {__title__}.utils:seed",
+            f"{__title__}-replay = {__title__}.commands:replay",
         ]
     },
     description="Cursor-On-Target Transform Proxy",
@@ -84,5 +85,9 @@ setuptools.setup(
         "License :: OSI Approved :: Apache Software License",
     ],
     keywords=["Cursor On Target", "ATAK", "TAK", "COT"],
-    extras_require={"with_pandas": "pandas"},
+    extras_require={
+        "with_pandas": "pandas",
+        "with_uvloop": "uvloop",
+        "with_takproto": "takproto",
+    },
 )
@@ -0,0 +1,985 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+import asyncio
+import logging
+import types
+
+from configparser import ConfigParser
+
+import aiohttp
+import pytest
+import pytest_asyncio
+import pytak
+
+from aiohttp import web
+
+import cotproxy
+
+
+__author__ = "Greg Albrecht W2GMD <oss@undef.net>"
+__copyright__ = "Copyright 2022 Greg Albrecht"
+__license__ = "Apache License, Version 2.0"
+
+
+@pytest.fixture
+def sample_xml():
+    with open("tests/sample.xml", "rb") as sample:
+        return sample.read()
+
+
+def make_config(**kwargs):
+    config = ConfigParser()
+    config.add_section("cotproxy")
+    config["cotproxy"]["COT_URL"] = "udp://127.0.0.1:6969"
+    for key, val in kwargs.items():
+        config["cotproxy"][key] = str(val)
+    return config["cotproxy"]
+
+
+def test_peer_stats():
+    stats = cotproxy.PeerStats(("127.0.0.1", 1234))
+    for _ in range(5):
+        stats.update(100)
+    assert stats.events == 5
+    assert stats.bytes == 500
+    assert stats.rate > 0
+    assert stats.as_dict()["peer"] == ("127.0.0.1", 1234)
+
+
+@pytest.mark.asyncio
+async def test_tcp_listener_limits(sample_xml):
+    queue = asyncio.Queue()
+    config = make_config(MAX_CONNECTIONS=1, IDLE_TIMEOUT=0.2)
+    worker = cotproxy.NetWorker(queue, config)
+    server = await asyncio.start_server(worker.handle_rx, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+
+    async with server:
+        _, writer1 = await asyncio.open_connection("127.0.0.1", port)
+        writer1.write(sample_xml)
+        await writer1.drain()
+        event = await asyncio.wait_for(queue.get(), 1)
+        assert isinstance(event, cotproxy.CoTEvent)
+        assert event.uid == "MMSI-993692001"
+        assert len(worker.peer_stats()) == 1
+        assert worker.peer_stats()[0]["events"] == 1
+
+        # PyTAK's logger doesn't propagate, so capture its records directly:
+        records = []
+        handler = logging.Handler(logging.INFO)
+        handler.emit = records.append
+        level = worker._logger.level
+        worker._logger.setLevel(logging.INFO)
+        worker._logger.addHandler(handler)
+        try:
+            worker.report_peers()
+            worker.peers[None] = cotproxy.PeerStats(None)
+            worker.report_peers()
+            del worker.peers[None]
+        finally:
+            worker._logger.removeHandler(handler)
+            worker._logger.setLevel(level)
+        messages = [record.getMessage() for record in records]
+        assert messages[0].startswith("peers=1 top=[127.0.0.1:")
+        assert messages[1].startswith("peers=2 top=[")
+        assert "None 0.0/s" in messages[1]
+
+        # Second connection is over MAX_CONNECTIONS and gets closed:
+        reader2, _ = await asyncio.open_connection("127.0.0.1", port)
+        assert await asyncio.wait_for(reader2.read(), 1) == b""
+
+        # First connection is closed after IDLE_TIMEOUT:
+        await asyncio.sleep(0.4)
+        assert worker.peer_stats() == []
+        writer1.close()
+
+
+@pytest.mark.asyncio
+async def test_tcp_listener_proto(sample_xml):
+    takproto = pytest.importorskip("takproto")
+    stream = bytes(takproto.xml2proto(sample_xml, takproto.TAKProtoVer.STREAM))
+    queue = asyncio.Queue()
+    worker = cotproxy.NetWorker(queue, make_config())
+    server = await asyncio.start_server(worker.handle_rx, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+
+    async with server:
+        _, writer = await asyncio.open_connection("127.0.0.1", port)
+        # TAK Protocol & XML Events may be mixed on one connection:
+        writer.write(stream + sample_xml + stream[:10])
+        await writer.drain()
+        await asyncio.sleep(0.05)
+        writer.write(stream[10:])
+        await writer.drain()
+        events = [await asyncio.wait_for(queue.get(), 1) for _ in range(3)]
+        assert [event.uid for event in events] == ["MMSI-993692001"] * 3
+        writer.close()
+
+
+@pytest.mark.asyncio
+async def test_fanout_worker():
+    primary, other = asyncio.Queue(), asyncio.Queue(1)
+    queue = asyncio.Queue()
+    worker = cotproxy.FanoutWorker(queue, make_config(), [primary, other])
+    await worker.handle_data(b"one")
+    await worker.handle_data(b"two")
+    assert primary.qsize() == 2
+    assert other.get_nowait() == b"one"
+    assert worker.dropped == 1
+
+
+@pytest.mark.asyncio
+async def test_stale_events_dropped(sample_xml):
+    tf_queue = asyncio.Queue()
+    worker = cotproxy.COTProxyWorker(asyncio.Queue(), make_config(), tf_queue)
+    # sample.xml went stale in 2022, so it must never reach handle_data():
+    tf_queue.put_nowait(cotproxy.CoTEvent.from_bytes(sample_xml))
+    await worker.read_queue()
+    assert worker.stats["stale"] == 1
+    assert worker.stats["max_lag"] > 0
+
+
+def make_event(cot_type, uid="test"):
+    return cotproxy.CoTEvent(b"", uid=uid, cot_type=cot_type)
+
+
+@pytest.mark.asyncio
+async def test_type_priority_queue():
+    queue = cotproxy.TypePriorityQueue(3, {"b-a-o-": 0, "a-f-G": 1})
+    queue.put_nowait(make_event("a-n-A-C-F"))
+    queue.put_nowait(make_event("a-f-G-U-C"))
+    queue.put_nowait(make_event("b-a-o-tbl"))
+    assert (await queue.get()).cot_type == "b-a-o-tbl"
+
+    # Full queue sheds the lowest class for an emergency:
+    queue.put_nowait(make_event("a-f-G-U-C", "2"))
+    queue.put_nowait(make_event("b-a-o-pan"))
+    assert queue.dropped == 1
+    assert [(await queue.get()).cot_type for _ in range(3)] == [
+        "b-a-o-pan",
+        "a-f-G-U-C",
+        "a-f-G-U-C",
+    ]
+
+    # ...but never sheds a higher class for a lower one:
+    for _ in range(3):
+        queue.put_nowait(make_event("b-a-o-tbl"))
+    with pytest.raises(asyncio.QueueFull):
+        queue.put_nowait(make_event("a-n-A-C-F"))
+
+
+@pytest.mark.asyncio
+async def test_type_priority_queue_starvation():
+    queue = cotproxy.TypePriorityQueue(0, {"b-a-o-": 0}, max_wait=0)
+    queue.put_nowait(make_event("a-n-A-C-F"))
+    for _ in range(20):
+        queue.put_nowait(make_event("b-a-o-tbl"))
+    served = [(await queue.get()).cot_type for _ in range(10)]
+    assert "a-n-A-C-F" in served
+
+
+def test_egress_spool(tmp_path):
+    spool = cotproxy.EgressSpool(str(tmp_path), segment_bytes=64)
+    for i in range(10):
+        spool.append(b"event-%d" % i)
+    assert len(list(tmp_path.iterdir())) > 1
+    assert [spool.pop() for _ in range(3)] == [b"event-0", b"event-1", b"event-2"]
+    spool.close()
+
+    # Spooled Events survive a restart, the partially drained segment is redelivered:
+    spool = cotproxy.EgressSpool(str(tmp_path), segment_bytes=64)
+    drained = []
+    while True:
+        data = spool.pop()
+        if data is None:
+            break
+        drained.append(data)
+    assert drained[-1] == b"event-9"
+    assert len(spool) == 0
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_egress_spool_caps(tmp_path):
+    spool = cotproxy.EgressSpool(str(tmp_path), max_bytes=200, segment_bytes=64)
+    for i in range(100):
+        spool.append(b"event-%d" % i)
+    assert len(spool) <= 200 + 64
+    assert spool.pop() != b"event-0"
+
+    spool = cotproxy.EgressSpool(str(tmp_path / "aged"), max_age=1)
+    spool.append(b"old")
+    spool.close()
+    with open(next((tmp_path / "aged").iterdir()), "wb") as seg_fd:
+        seg_fd.write(cotproxy.pack_record(0, b"old"))
+    spool = cotproxy.EgressSpool(str(tmp_path / "aged"), max_age=1)
+    assert spool.pop() is None
+    assert spool.dropped == 1
+
+
+@pytest.mark.asyncio
+async def test_spool_worker(tmp_path):
+    tx_queue = asyncio.Queue(1)
+    worker = cotproxy.SpoolWorker(
+        asyncio.Queue(), make_config(SPOOL_DIR=tmp_path), tx_queue
+    )
+    for i in range(3):
+        await worker.handle_data(b"event-%d" % i)
+    assert tx_queue.qsize() == 1
+    assert len(worker.spool) > 0
+
+    drain = asyncio.ensure_future(worker.drain(0.01))
+    assert [await tx_queue.get() for _ in range(3)] == [
+        b"event-0",
+        b"event-1",
+        b"event-2",
+    ]
+    drain.cancel()
+    worker.spool.close()
+
+
+@pytest.mark.asyncio
+async def test_spool_worker_reconnect(tmp_path):
+    config = make_config(SPOOL_DIR=tmp_path)
+    egress_queue = asyncio.Queue()
+    worker = cotproxy.SpoolWorker(egress_queue, config, asyncio.Queue())
+    task = asyncio.ensure_future(worker.run())
+    for i in range(2):
+        egress_queue.put_nowait(b"event-%d" % i)
+    await asyncio.sleep(0)
+    egress_queue.put_nowait(b"event-2")
+    assert worker.tx_queue.qsize() == 2
+    # The connection fails, PyTAK stops every Worker:
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+
+    # Reconnected, with new queues:
+    tx_queue = asyncio.Queue()
+    worker = cotproxy.SpoolWorker(asyncio.Queue(), config, tx_queue)
+    drain = asyncio.ensure_future(worker.drain(0.01))
+    assert [await tx_queue.get() for _ in range(3)] == [
+        b"event-0",
+        b"event-1",
+        b"event-2",
+    ]
+    drain.cancel()
+    worker.spool.close()
+
+
+@pytest.mark.asyncio
+async def test_capture_and_replay(tmp_path, sample_xml):
+    capture_file = str(tmp_path / "capture.cot.gz")
+    capture = cotproxy.CaptureWriter(capture_file)
+    listener = cotproxy.NetListener(asyncio.Queue(), asyncio.Event(), capture)
+    for _ in range(3):
+        listener.datagram_received(sample_xml, ("127.0.0.1", 1234))
+    capture.close()
+    assert [data for _, data in cotproxy.read_capture(capture_file)] == [sample_xml] * 3
+
+    queue = asyncio.Queue()
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(
+        lambda: cotproxy.NetListener(queue, asyncio.Event()),
+        local_addr=("127.0.0.1", 0),
+    )
+    port = transport.get_extra_info("sockname")[1]
+    events, size, _ = await cotproxy.replay_capture(
+        capture_file, f"udp://127.0.0.1:{port}", 0
+    )
+    assert (events, size) == (3, len(sample_xml) * 3)
+    event = await asyncio.wait_for(queue.get(), 1)
+    assert event.uid == "MMSI-993692001"
+    transport.close()
+
+
+@pytest.mark.asyncio
+async def test_capture_not_closed(tmp_path, sample_xml):
+    capture_file = str(tmp_path / "capture.cot.gz")
+    capture = cotproxy.CaptureWriter(capture_file)
+    capture.FLUSH_INTERVAL = 0.01
+    flusher = asyncio.ensure_future(capture.flush_periodically())
+    for _ in range(3):
+        capture.write(sample_xml)
+    await asyncio.sleep(0.05)
+    flusher.cancel()
+
+    # Killed without closing the capture, it's read up to the last flush:
+    assert [data for _, data in cotproxy.read_capture(capture_file)] == [sample_xml] * 3
+    capture.write(sample_xml)
+    capture.close()
+
+
+def test_cot_event_from_bytes(sample_xml):
+    event = cotproxy.CoTEvent.from_bytes(sample_xml)
+    assert event.uid == "MMSI-993692001"
+    assert event.cot_type == "a-n-S-N"
+    assert event.callsign == "AtoN SF"
+    assert event.time == cotproxy.cot_time_to_epoch("2022-03-29T19:39:27.442994Z")
+    assert event.stale > event.time
+    assert event.lat == pytest.approx(37.74993333333333)
+    assert event.lon == pytest.approx(-122.69277666666666)
+    assert event.element().attrib["uid"] == event.uid
+    assert not hasattr(event, "__dict__")
+
+
+@pytest.mark.asyncio
+async def test_transform_event(sample_xml):
+    tx_queue = asyncio.Queue()
+    worker = cotproxy.COTProxyWorker(tx_queue, make_config(), asyncio.Queue())
+    event = cotproxy.CoTEvent.from_bytes(sample_xml)
+    await worker.transform_event(event, {"active": True, "callsign": "TACO1"})
+    assert cotproxy.CoTEvent.from_bytes(await tx_queue.get()).callsign == "TACO1"
+
+    await worker.transform_event(event, {"active": False, "callsign": "TACO1"})
+    assert await tx_queue.get() == sample_xml
+
+    # Malformed Events are dropped rather than passed on untransformed:
+    malformed = cotproxy.CoTEvent.from_bytes(sample_xml.replace(b"</detail>", b""))
+    await worker.transform_event(malformed, {"active": True, "callsign": "TACO1"})
+    assert tx_queue.empty()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("pass_all", [True, False])
+async def test_pass_all_transformed(pass_all):
+    tx_queue = asyncio.Queue()
+    config = make_config(PASS_ALL=pass_all)
+    worker = cotproxy.COTProxyWorker(tx_queue, config, asyncio.Queue())
+
+    async def get(uid):
+        return {"active": uid != "inactive", "callsign": "TACO1"}
+
+    worker.lookup = types.SimpleNamespace(get=get)
+    await worker.handle_data(cotproxy.CoTEvent.from_bytes(EVENT_XML % b"active"))
+    await worker.handle_data(cotproxy.CoTEvent.from_bytes(EVENT_XML % b"inactive"))
+    await worker.handle_data(cotproxy.CoTEvent.from_bytes(EVENT_XML % b"&"))
+    sent = [tx_queue.get_nowait() for _ in range(tx_queue.qsize())]
+
+    # As always, with PASS_ALL Events are passed again as they were sent:
+    transformed = cotproxy.render_transform(
+        (EVENT_XML % b"active", {"active": True, "callsign": "TACO1"})
+    )
+    expected = [transformed, EVENT_XML % b"inactive"]
+    if pass_all:
+        expected = [transformed, transformed] + [EVENT_XML % b"inactive"] * 2
+    assert sent == expected
+
+
+def test_settings_reload(tmp_path):
+    config_file = tmp_path / "config.ini"
+    worker = cotproxy.COTProxyWorker(
+        asyncio.Queue(), make_config(CONFIG_FILE=config_file), asyncio.Queue()
+    )
+    assert worker.settings.pass_all is False
+
+    config_file.write_text("[cotproxy]\nPASS_ALL = true\nAUTO_ADD = yes\n")
+    old_settings = worker.settings
+    worker.reload()
+    assert worker.settings.pass_all is True
+    assert worker.settings.auto_add is True
+    assert old_settings.pass_all is False
+    with pytest.raises(AttributeError):
+        worker.settings.pass_all = False
+
+    # A broken config keeps the current settings:
+    config_file.write_text("[cotproxy]\nSTATS_INTERVAL = soon\n")
+    worker.reload()
+    assert worker.settings.pass_all is True
+
+    # Reloaded settings survive the Worker being recreated on reconnect:
+    worker = cotproxy.COTProxyWorker(
+        asyncio.Queue(), make_config(CONFIG_FILE=config_file), asyncio.Queue()
+    )
+    assert worker.settings.pass_all is True
+    assert worker.settings.auto_add is True
+
+
+def test_track_thinner():
+    thinner = cotproxy.TrackThinner(10, distance=50, course=15, altitude=30)
+
+    def report(seconds, lat, course=0.0, hae=0.0, cot_type="a-f-A"):
+        event = cotproxy.CoTEvent(
+            b"",
+            "ICAO-1",
+            cot_type,
+            time=seconds,
+            lat=lat,
+            lon=0,
+            hae=hae,
+            course=course,
+        )
+        return thinner.forward(event)
+
+    assert report(0, 0.0)
+    assert not report(1, 0.0001)  # ~11m
+    assert report(2, 0.001)  # ~111m
+    assert not report(3, 0.001, course=10)
+    assert report(4, 0.001, course=20)
+    assert report(5, 0.001, course=20, hae=100)
+    assert report(16, 0.001, course=20, hae=100)
+    assert not report(17, 0.001, course=20, hae=100)
+    assert report(18, 0.001, cot_type="b-a-o-tbl")
+    assert thinner.thinned == 3
+
+    thinner.max_tracks = 1
+    thinner.forward(cotproxy.CoTEvent(b"", "ICAO-2", "a-f-A", time=0, lat=0, lon=0))
+    assert list(thinner.tracks) == ["ICAO-2"]
+
+
+def test_track_thinner_config():
+    assert cotproxy.TrackThinner.from_config(make_config()) is None
+    thinner = cotproxy.TrackThinner.from_config(make_config(THIN_INTERVAL=5))
+    assert thinner.interval == 5
+    assert thinner.distance == cotproxy.DEFAULT_THIN_DISTANCE
+
+
+def test_geofence_index(sample_xml):
+    index = cotproxy.GeofenceIndex.from_geojson(
+        "tests/data/geofences.geojson", cell_size=0.5
+    )
+    assert index.filtering
+    # sample.xml is off the Golden Gate, inside both fences:
+    admit, transform = index.match(cotproxy.CoTEvent.from_bytes(sample_xml))
+    assert admit
+    assert transform == {"cot_type": "a-f-S"}
+
+    def at(lat, lon):
+        return cotproxy.CoTEvent(b"", "test", lat=lat, lon=lon)
+
+    assert index.match(at(37.1, -121.6)) == (True, None)
+    assert index.match(at(37.75, -122.25)) == (False, None)  # in the hole
+    assert index.match(at(40.0, -122.0)) == (False, None)
+    assert index.match(cotproxy.CoTEvent(b"")) == (True, None)
+    assert index.dropped == 2
+
+    # Inside only a transform fence, while there are filter fences:
+    square = [[[[0, 0], [1, 0], [1, 1], [0, 1], [0, 0]]]]
+    index = cotproxy.GeofenceIndex([(square, {"cot_type": "a-f-S"})])
+    assert not index.filtering
+    assert index.match(at(0.5, 0.5)) == (True, {"cot_type": "a-f-S"})
+    assert index.match(at(5.0, 5.0)) == (True, None)
+    far = [[[[10, 10], [11, 10], [11, 11], [10, 11], [10, 10]]]]
+    index = cotproxy.GeofenceIndex([(square, {"cot_type": "a-f-S"}), (far, None)])
+    assert index.match(at(0.5, 0.5)) == (False, {"cot_type": "a-f-S"})
+
+
+@pytest.mark.asyncio
+async def test_geofence_transform(sample_xml):
+    tx_queue = asyncio.Queue()
+    config = make_config(GEOFENCE_FILE="tests/data/geofences.geojson")
+    worker = cotproxy.COTProxyWorker(tx_queue, config, asyncio.Queue())
+    event = cotproxy.CoTEvent.from_bytes(sample_xml)
+    await worker.handle_data(event, use_proxy=False)
+    assert cotproxy.CoTEvent.from_bytes(await tx_queue.get()).cot_type == "a-f-S"
+
+    event.lat = 40.0
+    await worker.handle_data(event, use_proxy=False)
+    assert tx_queue.empty()
+
+    # An Event without a contact, inside a fence transforming callsigns:
+    square = [[[[0, 0], [1, 0], [1, 1], [0, 1], [0, 0]]]]
+    worker.geofences = cotproxy.GeofenceIndex([(square, {"callsign": "FENCED"})])
+    contactless = (
+        b'<event version="2.0" uid="%s" type="a-f-G-U-C" how="m-g">'
+        b'<point lat="0.5" lon="0.5" hae="1.0" ce="1.0" le="1.0"/></event>'
+    )
+    event = cotproxy.CoTEvent.from_bytes(contactless % b"bare")
+    await worker.handle_data(event, use_proxy=False)
+    assert tx_queue.empty()
+    event = cotproxy.CoTEvent.from_bytes(EVENT_XML % b"other")
+    event.lat = event.lon = 0.5
+    await worker.handle_data(event, use_proxy=False)
+    assert cotproxy.CoTEvent.from_bytes(await tx_queue.get()).callsign == "FENCED"
+
+
+class FakeCPAPI:
+    """A stand-in COTProxyWeb API recording the calls made to it."""
+
+    def __init__(self):
+        self.calls = []
+        self.transforms = {}
+        self.batch = True
+        self.stream = None
+        self.last_event_ids = []
+        self.icons = {}
+        # Statuses to fail the next requests to a path with, in order:
+        self.fail_on = {}
+        self.url = None
+
+    def failure(self, path):
+        statuses = self.fail_on.get(path)
+        if statuses:
+            return web.Response(status=statuses.pop(0))
+        return None
+
+    async def create(self, request):
+        self.calls.append((request.path, await request.json()))
+        return self.failure(request.path) or web.json_response({}, status=201)
+
+    async def get_tf(self, request):
+        uid = request.match_info["uid"]
+        self.calls.append((request.path, uid))
+        failure = self.failure(request.path)
+        if failure:
+            return failure
+        if uid not in self.transforms:
+            return web.Response(status=404)
+        return web.json_response(self.transforms[uid])
+
+    async def batch_tf(self, request):
+        uids = (await request.json())["uids"]
+        self.calls.append((request.path, uids))
+        failure = self.failure(request.path)
+        if failure:
+            return failure
+        if not self.batch:
+            return web.Response(status=404)
+        return web.json_response(
+            [self.transforms[uid] for uid in uids if uid in self.transforms]
+        )
+
+    async def get_icon(self, request):
+        icon = request.match_info["icon"]
+        self.calls.append((request.path, icon))
+        if icon not in self.icons:
+            return web.Response(status=404)
+        return web.json_response({"iconset": self.icons[icon][0]})
+
+    async def get_iconset(self, request):
+        iconsets = dict(self.icons.values())
+        return web.json_response({"name": iconsets[request.match_info["uuid"]]})
+
+    async def events(self, request):
+        self.last_event_ids.append(request.headers.get("Last-Event-ID"))
+        if self.stream is None:
+            return web.Response(status=404)
+        return web.Response(text=self.stream, content_type="text/event-stream")
+
+
+@pytest_asyncio.fixture
+async def cpapi():
+    fake = FakeCPAPI()
+    app = web.Application()
+    app.router.add_post("/co/", fake.create)
+    app.router.add_post("/tf/", fake.create)
+    app.router.add_post("/tf/batch/", fake.batch_tf)
+    app.router.add_get("/tf/events/", fake.events)
+    app.router.add_get("/tf/{uid}", fake.get_tf)
+    app.router.add_get("/icon/{icon}", fake.get_icon)
+    app.router.add_get("/iconset/{uuid}", fake.get_iconset)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    fake.url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/"
+    yield fake
+    await runner.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_auto_add_write_behind(cpapi, sample_xml):
+    cpapi_url, calls = cpapi.url, cpapi.calls
+    # The first Transform creation fails, and is retried:
+    cpapi.fail_on = {"/tf/": [503]}
+    auto_add_queue = asyncio.Queue()
+    config = make_config(AUTO_ADD=True, AUTO_ADD_WINDOW=0.05, CPAPI_URL=cpapi_url)
+    proxy = cotproxy.COTProxyWorker(
+        asyncio.Queue(), config, asyncio.Queue(), auto_add_queue
+    )
+    event = cotproxy.CoTEvent.from_bytes(sample_xml)
+    for _ in range(3):
+        await proxy.create_co_and_tf(event)
+    assert auto_add_queue.qsize() == 3
+
+    worker = cotproxy.AutoAddWorker(auto_add_queue, config)
+    worker.RETRY_BACKOFF = 0
+    batch = await worker.collect()
+    assert list(batch) == ["MMSI-993692001"]
+
+    async with aiohttp.ClientSession(cpapi_url) as worker.session:
+        await worker.flush(batch)
+        # Already added UIDs aren't added again:
+        await worker.flush(batch)
+
+    assert [path for path, _ in calls] == ["/co/", "/tf/", "/co/", "/tf/"]
+    assert calls[-1][1]["callsign"] == "AtoN SF"
+    assert calls[-1][1]["remarks"].startswith("SF AtoN")
+
+
+@pytest.mark.asyncio
+async def test_auto_add_survives_errors(cpapi):
+    auto_add_queue = asyncio.Queue()
+    config = make_config(AUTO_ADD=True, AUTO_ADD_WINDOW=0, CPAPI_URL=cpapi.url)
+    worker = cotproxy.AutoAddWorker(auto_add_queue, config)
+
+    flush = worker.flush
+    failures = []
+
+    async def flaky_flush(batch):
+        if not failures:
+            failures.append(batch)
+            raise RuntimeError("unexpected")
+        await flush(batch)
+
+    worker.flush = flaky_flush
+    await auto_add_queue.put(cotproxy.CoTEvent.from_bytes(EVENT_XML % b"first"))
+    # Matches the Event regexes, but isn't well-formed XML:
+    malformed = EVENT_XML.replace(b"ORIGINAL", b"X & Y") % b"malformed"
+    await auto_add_queue.put(cotproxy.CoTEvent.from_bytes(malformed))
+
+    task = asyncio.ensure_future(worker.run())
+    for _ in range(100):
+        if "malformed" in worker.added:
+            break
+        await asyncio.sleep(0.01)
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+
+    assert failures and "malformed" in worker.added
+    assert cpapi.calls[-1] == (
+        "/tf/",
+        {
+            "cot_uid": "malformed",
+            "cot_type": "a-f-G-U-C",
+            "callsign": "X & Y",
+            "remarks": None,
+        },
+    )
+
+
+def test_transform_cache():
+    cache = cotproxy.TransformCache(ttl=60, max_size=2)
+    assert cache.get("a") == (False, None)
+    cache.put("a", {"callsign": "A"})
+    cache.put("b", None)
+    assert cache.get("a") == (True, {"callsign": "A"})
+    assert cache.get("b") == (True, None)
+    cache.put("c", None)
+    assert cache.get("a") == (False, None)
+
+    cache = cotproxy.TransformCache(ttl=0)
+    cache.put("a", {"callsign": "A"})
+    assert cache.get("a") == (False, None)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("batch", [True, False])
+async def test_transform_lookup(cpapi, batch):
+    cpapi.batch = batch
+    cpapi.transforms = {"a": {"cot_uid": "a", "callsign": "A"}}
+    async with aiohttp.ClientSession(cpapi.url) as session:
+        lookup = cotproxy.TransformLookup(session, cotproxy.TransformCache())
+        results = await asyncio.gather(
+            lookup.get("a"), lookup.get("b"), lookup.get("a")
+        )
+        assert results == [{"cot_uid": "a", "callsign": "A"}, None, results[0]]
+        # Misses are now cached:
+        assert await lookup.get("b") is None
+
+    paths = [path for path, _ in cpapi.calls]
+    if batch:
+        assert paths == ["/tf/batch/"]
+        assert cpapi.calls[0][1] == ["a", "b"]
+    else:
+        assert paths == ["/tf/batch/", "/tf/a", "/tf/b"]
+        assert not lookup.batch_supported
+
+
+@pytest.mark.asyncio
+async def test_transform_lookup_errors(cpapi):
+    cpapi.transforms = {"a": {"cot_uid": "a", "active": True, "callsign": "A"}}
+    # The batch fails because of 'b', whose own lookup then fails too:
+    cpapi.fail_on = {"/tf/batch/": [500], "/tf/b": [500]}
+    tf_queue = asyncio.Queue()
+    tx_queue = asyncio.Queue()
+    auto_add_queue = asyncio.Queue()
+    config = make_config(PASS_ALL=True, AUTO_ADD=True, CPAPI_URL=cpapi.url)
+    worker = cotproxy.COTProxyWorker(tx_queue, config, tf_queue, auto_add_queue)
+    for uid in (b"a", b"b", b"c"):
+        tf_queue.put_nowait(cotproxy.CoTEvent.from_bytes(EVENT_XML % uid))
+
+    async with aiohttp.ClientSession(cpapi.url) as worker.session:
+        worker.lookup = cotproxy.TransformLookup(worker.session, worker.cache)
+        await worker.read_queue()
+
+    forwarded = [tx_queue.get_nowait() for _ in range(tx_queue.qsize())]
+    # With PASS_ALL, the transformed Event is passed again:
+    assert len(forwarded) == 4
+    assert b'callsign="A"' in forwarded[0] and forwarded[0] == forwarded[1]
+    assert EVENT_XML % b"b" in forwarded and EVENT_XML % b"c" in forwarded
+    # The failed lookup isn't cached, nor is its UID added:
+    assert worker.cache.get("b") == (False, None)
+    assert worker.cache.get("c") == (True, None)
+    assert [event.uid for event in auto_add_queue._queue] == ["c"]
+
+
+@pytest.mark.asyncio
+async def test_cache_warm_restart(cpapi, tmp_path):
+    cache_file = str(tmp_path / "cache.bin")
+    config = make_config(CPAPI_URL=cpapi.url, CACHE_FILE=cache_file)
+
+    worker = cotproxy.COTProxyWorker(asyncio.Queue(), config, asyncio.Queue())
+    worker.cache.put("a", {"cot_uid": "a", "callsign": "OLD"})
+    worker.cache.put("b", None)
+    worker.icons.put("icon", "set/name/icon")
+    worker.icons.put("gone", "set/name/gone")
+    worker.save_cache()
+
+    worker = cotproxy.COTProxyWorker(asyncio.Queue(), config, asyncio.Queue())
+    assert sorted(worker.load_cache()) == ["a", "b"]
+    assert worker.cache.get("a") == (True, {"cot_uid": "a", "callsign": "OLD"})
+    assert worker.icons.get("icon") == (True, "set/name/icon")
+
+    cpapi.transforms = {"a": {"cot_uid": "a", "callsign": "NEW"}}
+    cpapi.icons = {"icon": ("set", "renamed")}
+    async with aiohttp.ClientSession(cpapi.url) as worker.session:
+        worker.lookup = cotproxy.TransformLookup(worker.session, worker.cache)
+        await worker.revalidate(["a", "b"])
+    assert worker.cache.get("a") == (True, {"cot_uid": "a", "callsign": "NEW"})
+    assert worker.cache.get("b") == (True, None)
+    assert worker.icons.get("icon") == (True, "set/renamed/icon")
+    assert worker.icons.get("gone") == (True, None)
+
+
+@pytest.mark.asyncio
+async def test_coalescing_tx_worker():
+    received = bytearray()
+
+    async def handle(reader, writer):
+        received.extend(await reader.read())
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    async with server:
+        _, writer = await asyncio.open_connection("127.0.0.1", port)
+        queue = asyncio.Queue()
+        config = make_config(EGRESS_MAX_COUNT=4, EGRESS_LINGER=0.1)
+        worker = cotproxy.CoalescingTXWorker(queue, config, writer)
+
+        for index in range(6):
+            queue.put_nowait(f"<event uid='{index}'/>".encode())
+        await worker.run_once()
+        assert (worker.writes, worker.events) == (1, 4)
+
+        # The rest of the queue, plus anything arriving within EGRESS_LINGER:
+        asyncio.get_running_loop().call_later(0.02, queue.put_nowait, b"<late/>")
+        await worker.run_once()
+        assert (worker.writes, worker.events) == (2, 7)
+
+        writer.close()
+        await writer.wait_closed()
+        await asyncio.sleep(0.05)
+    assert received.count(b"<event") == 6
+    assert received.endswith(b"<late/>")
+
+
+@pytest.mark.asyncio
+async def test_coalesce_tx_workers():
+    server = await asyncio.start_server(lambda reader, writer: None, "127.0.0.1", 0)
+    _, writer = await asyncio.open_connection(*server.sockets[0].getsockname())
+    tcp = pytak.TXWorker(asyncio.Queue(), make_config(), writer)
+    udp = pytak.TXWorker(asyncio.Queue(), make_config(), object())
+    clitool = types.SimpleNamespace(tasks={tcp, udp})
+    clitool.add_task = clitool.tasks.add
+
+    cotproxy.coalesce_tx_workers(clitool)
+    assert udp in clitool.tasks and tcp not in clitool.tasks
+    (coalescing,) = clitool.tasks - {udp}
+    assert isinstance(coalescing, cotproxy.CoalescingTXWorker)
+    assert coalescing.queue is tcp.queue and coalescing.writer is writer
+    writer.close()
+    server.close()
+
+
+def test_load_shedder():
+    shedder = cotproxy.LoadShedder(target=1.0, hold=0)
+    shedder.ALPHA = 1.0
+    assert not shedder.update(0.5)
+    modes = []
+    for _ in range(4):
+        shedder.update(5.0)
+        modes.append(shedder.name)
+    assert modes == ["CACHE_ONLY", "PASS_THROUGH", "DROP_LOW", "DROP_LOW"]
+    # Between half & all of the target, the mode holds:
+    assert not shedder.update(0.8)
+    for _ in range(3):
+        assert shedder.update(0.1)
+    assert shedder.mode == cotproxy.LoadShedder.NORMAL
+
+    shedder = cotproxy.LoadShedder(target=1.0, hold=60)
+    assert shedder.update(50.0) and not shedder.update(50.0)
+
+    assert cotproxy.LoadShedder.from_config(make_config()) is None
+    assert cotproxy.LoadShedder.from_config(make_config(SHED_TARGET=0.5)).target == 0.5
+
+
+EVENT_XML = (
+    b'<event version="2.0" uid="%s" type="a-f-G-U-C" how="m-g">'
+    b'<point lat="1.0" lon="1.0" hae="1.0" ce="1.0" le="1.0"/>'
+    b'<detail><contact callsign="ORIGINAL"/></detail></event>'
+)
+
+
+@pytest.mark.asyncio
+async def test_load_shedding_modes():
+    tf_queue = cotproxy.TypePriorityQueue(0, {"a-f-G": 0})
+    tx_queue = asyncio.Queue()
+    config = make_config(SHED_TARGET=1.0, SHED_HOLD=0, PASS_ALL=True)
+    worker = cotproxy.COTProxyWorker(tx_queue, config, tf_queue)
+    worker.cache.put("cached", {"active": True, "callsign": "CACHED"})
+
+    # CACHE_ONLY: cached Transforms apply, misses pass without a lookup:
+    worker.shedder.mode = cotproxy.LoadShedder.CACHE_ONLY
+    await worker.handle_data(cotproxy.CoTEvent.from_bytes(EVENT_XML % b"cached"))
+    await worker.handle_data(cotproxy.CoTEvent.from_bytes(EVENT_XML % b"miss"))
+    assert b"CACHED" in tx_queue.get_nowait()
+    assert b"CACHED" in tx_queue.get_nowait()  # Passed again with PASS_ALL.
+    assert tx_queue.get_nowait() == EVENT_XML % b"miss"
+
+    # DROP_LOW: the lowest priority class is dropped, the rest pass through:
+    worker.shedder.mode = cotproxy.LoadShedder.DROP_LOW
+    worker.shedder.sojourn = 10.0
+    tf_queue.put_nowait(cotproxy.CoTEvent.from_bytes(EVENT_XML % b"cached"))
+    tf_queue.put_nowait(cotproxy.CoTEvent(b"<event/>", uid="low", cot_type="b-m-p"))
+    await worker.read_queue()
+    assert tx_queue.get_nowait() == EVENT_XML % b"cached"
+    assert tx_queue.empty()
+    assert worker.stats["shed"] == 1
+
+
+@pytest.mark.asyncio
+async def test_load_shedding_pass_through():
+    tf_queue = cotproxy.TypePriorityQueue(0, {"a-f-G": 0})
+    tx_queue = asyncio.Queue()
+    config = make_config(SHED_TARGET=1.0, SHED_HOLD=0, PASS_ALL=False)
+    worker = cotproxy.COTProxyWorker(tx_queue, config, tf_queue)
+    worker.cache.put("cached", {"active": True, "callsign": "CACHED"})
+
+    # PASS_THROUGH: Events pass on as received, even without PASS_ALL:
+    worker.shedder.mode = cotproxy.LoadShedder.PASS_THROUGH
+    worker.shedder.sojourn = 10.0
+    tf_queue.put_nowait(cotproxy.CoTEvent.from_bytes(EVENT_XML % b"cached"))
+    tf_queue.put_nowait(cotproxy.CoTEvent.from_bytes(EVENT_XML % b"miss"))
+    await worker.read_queue()
+    assert tx_queue.get_nowait() == EVENT_XML % b"cached"
+    assert tx_queue.get_nowait() == EVENT_XML % b"miss"
+
+
+@pytest.mark.asyncio
+async def test_transform_subscription(cpapi):
+    cache = cotproxy.TransformCache()
+    cache.put("gone", {"cot_uid": "gone"})
+    async with aiohttp.ClientSession(cpapi.url) as session:
+        subscription = cotproxy.TransformSubscription(session, cache)
+        assert not await subscription.subscribe()
+
+        cpapi.stream = (
+            ": heartbeat\n\n"
+            "retry: 500\n\n"
+            'id: 1\nevent: insert\ndata: {"cot_uid": "a", "callsign": "A"}\n\n'
+            'id: 2\nevent: delete\ndata: {"cot_uid": "gone"}\n\n'
+        )
+        # Connecting without an event ID to resume from, Transforms already
+        # cached (e.g. restored) are served but still expire:
+        cache.put("fetched", {"cot_uid": "fetched"})
+        assert await subscription.subscribe()
+        assert cache.get("fetched")[0]
+        assert "fetched" in cache.snapshot()
+        cache.entries["fetched"] = (0, *cache.entries["fetched"][1:])
+        assert cache.get("fetched") == (False, None)
+        assert "fetched" not in cache.snapshot()
+        cache.put("fetched", {"cot_uid": "fetched"})
+        assert await subscription.subscribe()
+        cache.entries["fetched"] = (0, *cache.entries["fetched"][1:])
+        assert cache.get("fetched")[0]
+
+    assert cpapi.last_event_ids == [None, None, "2"]
+    assert subscription.retry == 0.5
+    assert cache.get("a") == (True, {"cot_uid": "a", "callsign": "A"})
+    assert cache.get("gone") == (True, None)
+
+    # While live, entries don't expire:
+    cache.live = True
+    cache.entries["a"] = (0, *cache.entries["a"][1:])
+    assert cache.get("a")[0]
+
+    # A lookup started before a pushed change doesn't overwrite it:
+    since = cache.generation
+    subscription.apply("update", '{"cot_uid": "a", "callsign": "NEW"}')
+    cache.put("a", {"cot_uid": "a", "callsign": "OLD"}, since)
+    assert cache.get("a")[1]["callsign"] == "NEW"
+
+    subscription.apply("reset", "")
+    assert cache.get("a") == (False, None)
+
+
+@pytest.mark.asyncio
+async def test_transform_subscription_survives_errors(cpapi):
+    cpapi.stream = "retry: 10\n\nevent: insert\ndata: [1]\n\n"
+    async with aiohttp.ClientSession(cpapi.url) as session:
+        subscription = cotproxy.TransformSubscription(
+            session, cotproxy.TransformCache()
+        )
+        task = asyncio.ensure_future(subscription.run())
+        for _ in range(100):
+            if len(cpapi.last_event_ids) > 1:
+                break
+            await asyncio.sleep(0.01)
+        assert not task.done()
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+    assert len(cpapi.last_event_ids) > 1
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("kind", ["thread", "process"])
+async def test_pool_batcher(kind, sample_xml):
+    pool = cotproxy.worker_pool(make_config(POOL=kind, POOL_WORKERS=2))
+    assert cotproxy.worker_pool(make_config(POOL=kind, POOL_WORKERS=2)) is pool
+    batcher = cotproxy.PoolBatcher(pool, cotproxy.parse_events, max_batch=2)
+    futures = [batcher.submit(sample_xml), batcher.submit(b"<event uid='a'/>")]
+    # A full batch is sent at once, the rest on the next loop iteration:
+    assert not batcher.pending
+    futures.append(batcher.submit(None))
+    assert len(batcher.pending) == 1
+    (event,) = await futures[0]
+    assert event.uid == "MMSI-993692001"
+    assert (await futures[1])[0].uid == "a"
+    with pytest.raises(TypeError):
+        await futures[2]
+
+
+@pytest.mark.asyncio
+async def test_event_parser_order():
+    queue = asyncio.Queue()
+    loop = asyncio.get_running_loop()
+    futures = {b"first": loop.create_future(), b"second": loop.create_future()}
+    parser = cotproxy.EventParser(queue, types.SimpleNamespace(submit=futures.get))
+    parser.feed(b"first")
+    parser.feed(b"second")
+    # The second result is ready first, but waits for the first:
+    futures[b"second"].set_result([make_event("a-f-G", "second")])
+    await asyncio.sleep(0)
+    assert queue.empty()
+    futures[b"first"].set_result([make_event("a-f-G", "first")])
+    await asyncio.sleep(0)
+    assert [queue.get_nowait().uid for _ in range(2)] == ["first", "second"]
+
+
+@pytest.mark.asyncio
+async def test_transform_event_pool():
+    tx_queue = asyncio.Queue()
+    worker = cotproxy.COTProxyWorker(
+        tx_queue,
+        make_config(POOL="thread"),
+        asyncio.Queue(),
+        pool=cotproxy.worker_pool(make_config(POOL="thread")),
+    )
+    event = cotproxy.CoTEvent.from_bytes(EVENT_XML % b"pooled")
+    await worker.transform_event(event, {"active": True, "callsign": "POOLED"})
+    assert b'callsign="POOLED"' in tx_queue.get_nowait()
+
+    malformed = cotproxy.CoTEvent.from_bytes(EVENT_XML % b"&")
+    await worker.transform_event(malformed, {"active": True, "callsign": "POOLED"})
+    assert tx_queue.empty()
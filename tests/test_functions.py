@@ -46,3 +46,108 @@ def test_transform_cot(sample_xml):
         new_cot.find("detail").find("contact").attrib["callsign"]
         == transform["callsign"]
     )
+
+
+def test_cot_time_to_epoch():
+    assert cotproxy.cot_time_to_epoch("1970-01-01T00:00:10Z") == 10
+    assert cotproxy.cot_time_to_epoch("2022-03-29T19:39:27.5Z") == 1648582767.5
+    assert cotproxy.cot_time_to_epoch("2022-03-29T19:39:27.442994Z") == pytest.approx(
+        1648582767.442994
+    )
+    assert cotproxy.cot_time_to_epoch("garbage") is None
+    assert cotproxy.cot_time_to_epoch(None) is None
+
+
+def test_parse_priority_classes():
+    classes = cotproxy.parse_priority_classes("b-a-o-:0, a-f-G:1,")
+    assert classes == {"b-a-o-": 0, "a-f-G": 1}
+
+
+def test_pack_unpack_records():
+    buf = cotproxy.pack_record(1.5, b"one") + cotproxy.pack_record(2.5, b"two")
+    records = list(cotproxy.unpack_records(buf + b"trunc"))
+    assert [(ts, data) for ts, data, _ in records] == [(1.5, b"one"), (2.5, b"two")]
+    assert records[-1][2] == len(buf)
+
+
+def test_parse_events(sample_xml):
+    data = sample_xml.encode() + b"\n<event uid='two' type=\"a-f-G\"/>"
+    assert len(cotproxy.split_events(data)) == 2
+    events = cotproxy.parse_events(data)
+    assert [event.uid for event in events] == ["MMSI-993692001", "two"]
+    assert events[1].cot_type == "a-f-G"
+    assert events[1].lat is None
+
+
+def test_distance():
+    assert cotproxy.distance(37.0, -122.0, 37.0, -122.0) == 0
+    # One degree of latitude is ~111km:
+    assert cotproxy.distance(37.0, -122.0, 38.0, -122.0) == pytest.approx(111195, 1e-3)
+
+
+def test_point_in_polygon():
+    square = [[0, 0], [10, 0], [10, 10], [0, 10], [0, 0]]
+    hole = [[4, 4], [6, 4], [6, 6], [4, 6], [4, 4]]
+    assert cotproxy.point_in_polygon(1, 1, [square])
+    assert not cotproxy.point_in_polygon(11, 1, [square])
+    assert not cotproxy.point_in_polygon(5, 5, [square, hole])
+    assert cotproxy.point_in_polygon(3, 5, [square, hole])
+
+
+def test_cache_snapshot(tmp_path):
+    path = str(tmp_path / "cache.bin")
+    snapshot = {"transforms": {"a": {"callsign": "A"}, "b": None}, "icons": {}}
+    assert cotproxy.save_cache_snapshot(path, snapshot) > 0
+    assert cotproxy.load_cache_snapshot(path) == snapshot
+
+    data = bytearray(open(path, "rb").read())
+    data[-1] ^= 0xFF
+    open(path, "wb").write(bytes(data))
+    with pytest.raises(ValueError):
+        cotproxy.load_cache_snapshot(path)
+
+    open(path, "wb").write(b"CPXC")
+    with pytest.raises(ValueError):
+        cotproxy.load_cache_snapshot(path)
+
+
+def test_event_loop_policy():
+    policy = cotproxy.event_loop_policy("asyncio")
+    assert isinstance(policy, asyncio.DefaultEventLoopPolicy)
+    policy = cotproxy.event_loop_policy("uvloop")
+    if cotproxy.functions.with_uvloop:
+        assert type(policy).__module__.startswith("uvloop")
+    else:
+        assert isinstance(policy, asyncio.DefaultEventLoopPolicy)
+    loop = policy.new_event_loop()
+    assert loop.run_until_complete(asyncio.sleep(0, "ok")) == "ok"
+    loop.close()
+
+
+def test_split_proto():
+    assert cotproxy.read_varint(b"\xac\x02") == (300, 2)
+    with pytest.raises(ValueError):
+        cotproxy.read_varint(b"\xac")
+    assert cotproxy.split_proto(b"\xbf\x01\xbfmesh") == [b"mesh"]
+    assert cotproxy.split_proto(b"\xbf\x03one\xbf\x03two") == [b"one", b"two"]
+    with pytest.raises(ValueError):
+        cotproxy.split_proto(b"\xbf\x05one")
+
+
+def test_parse_proto_events(sample_xml):
+    takproto = pytest.importorskip("takproto")
+    mesh = bytes(takproto.xml2proto(sample_xml, takproto.TAKProtoVer.MESH))
+    stream = bytes(takproto.xml2proto(sample_xml, takproto.TAKProtoVer.STREAM))
+    xml_event = cotproxy.parse_events(sample_xml.encode())[0]
+
+    for data, count in ((mesh, 1), (stream + stream, 2)):
+        events = cotproxy.parse_events(data)
+        assert len(events) == count
+        event = events[0]
+        for attr in ("uid", "cot_type", "callsign", "lat", "lon"):
+            assert getattr(event, attr) == getattr(xml_event, attr)
+        # TAK Protocol timestamps are in milliseconds:
+        assert event.stale == pytest.approx(xml_event.stale, abs=1e-3)
+        # Decoded to XML, so it can be transformed like any other Event:
+        element = cotproxy.transform_cot(event.element(), {"cot_type": "a-h-S"})
+        assert element.get("type") == "a-h-S"